@@ -0,0 +1,70 @@
+# cache.py module
+
+"""
+This module contains a small thread-safe cache with a time-to-live for every
+entry and least-recently-used eviction once it is full. Central uses it to
+remember recent analysis results, so that a host someone analyzed a few seconds
+ago doesn't need another round trip to every worker.
+
+Example usage:
+
+    import cache
+
+    c = cache.TTLCache(max_entries=1000, ttl=60)
+    c.put("www.google.com", results)
+    results = c.get("www.google.com")   # None if missing or expired
+"""
+
+import collections
+import threading
+import time
+
+"""TTLCache maps keys to values, forgetting each entry ttl seconds after it
+was put in the cache, and evicting the least recently used entry when more
+than max_entries are stored."""
+class TTLCache:
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict() # key -> (expiry time, value)
+        self.lock = threading.Lock()
+
+    """Return the value stored for key, or None if there is no such entry or
+    it has expired."""
+    def get(self, key):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    """Store value for key, replacing any older entry."""
+    def put(self, key, value):
+        expiry = time.monotonic() + self.ttl
+        with self.lock:
+            self.entries[key] = (expiry, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    """Forget the entry for key, if there is one."""
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    """Return a list of (key, value) pairs for all entries that haven't
+    expired, least recently used first."""
+    def items(self):
+        now = time.monotonic()
+        with self.lock:
+            return [(key, entry[1]) for (key, entry) in self.entries.items() if entry[0] > now]
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -1,19 +1,46 @@
 # Kevin E + Tim W + Liam D , 11/5/20
 # central server, opens/listens at port 8080 
-# sends urls to workers, calculates average from rtts, 
+# sends urls to workers, summarizes the rtts they measure, 
 # finds minimum + displays on webpage
 
 #!/usr/bin/env python3
-import os            # for os.path.isfile()
+import os            # for os.path.isfile() and os.path.expanduser()
 import socket        # for socket stuff
 import socketutil
+import channel       # for the framed protocol spoken with workers
+import cache         # for caching analysis results
+import staticcache   # for caching static files in memory
+import template      # for precompiled html page templates
+import httpparse     # for parsing http requests
+import logutil       # for leveled, queued logging
+import metrics       # for counters and histograms shown at /metrics
+import workerhealth  # for heartbeats and evicting unhealthy workers
+import workerregistry # for keeping track of registered workers
+import rttstore      # for keeping a history of rtt measurements on disk
+import prefixindex   # for reusing locations found for the same ip range
+import urlutil       # for normalizing target urls
+import measure       # for summarizing rtt samples
+import regionindex   # for distances between cloud regions
+try:
+    import estimator # for multilateration, needs numpy
+except ImportError:
+    estimator = None
 import sys           # for sys.argv
+import ipaddress     # for telling ip address targets from host names
 import urllib.parse  # for urllib.parse.unquote()
 import time          # for time.time()
 import threading     # for threading.Thread()
 import re            # for regex split()
 import random        # for random numbers
 import string        # for various string operations
+import itertools     # for itertools.count()
+import asyncio       # for the asyncio server mode
+import argparse      # for command-line options
+import atexit        # for writing out buffered measurements when exiting
+import email.utils   # for formatting and parsing http dates
+import json          # for batch analysis requests and results
+from concurrent.futures import ThreadPoolExecutor, Future # for dispatching jobs to workers
+from concurrent.futures import wait, FIRST_COMPLETED      # for streaming batch results
 
 import cloud
 
@@ -21,33 +48,184 @@ import cloud
 server_host = "" 
 server_port = 8080
 server_root = "./web_files"
-
-avg_rtt = []
-location = []
-workers = []
-coord = []
-ips = []
-
-# Global variables to keep track of statistics, with initial values. These get
-# updated by different connection handler threads. To avoid race conditions,
-# these should only be accessed within a "with" block, like this:
-#     with stats.lock:
-#        stats.tot_time += x
-#        if stats.max_time < x:
-#            ...
+analyze_deadline = 5.0 # seconds to wait for workers before showing partial results
+server_mode = "threads" # "threads" for a thread per connection, or "asyncio"
+server_backlog = 128    # max pending connections waiting to be accepted
+handler_threads = 64    # max concurrent request handlers in asyncio mode
+cache_ttl = 60.0        # seconds that analysis results are reused for a host
+cache_size = 1000       # max number of hosts with cached analysis results
+measure_mode = "connect" # how workers measure rtts, one of measure.MODES
+measure_samples = 5      # number of rtt samples each worker takes per job
+static_cache_bytes = 16 << 20  # max bytes of static files kept in memory
+static_max_file_size = 1 << 20 # bigger static files are streamed from disk
+select_mode = "all"    # "all" workers probe every target, or "adaptive" (two phases)
+coarse_workers = 4     # in adaptive mode, number of spread-out workers probed first
+coarse_samples = 2     # rtt samples each of those workers takes
+coarse_deadline = 2.0  # seconds to wait for them, out of analyze_deadline
+fine_workers = 4       # then, number of workers nearest the coarse estimate probed
+batch_group_size = 16  # hosts from one /analyze_batch request sent to the workers together
+batch_concurrency = 2  # groups of those hosts analyzed at the same time
+batch_max_targets = 50000 # max number of urls in one /analyze_batch request
+rtt_store_dir = os.path.expanduser("~/.geolocate_rtt_store") # where rtt measurements are kept, "" to not keep them
+history_max_age = 3600.0 # seconds of history /history looks at, unless asked otherwise
+prefix_max_age = 86400.0 # seconds a location found for an ip prefix is reused, 0 to never reuse
+prefix_max_radius = 500.0 # only reuse prefix locations at least this precise, in km
+
+# Registered workers, with their channels, locations, and health.
+workers = workerregistry.WorkerRegistry()
+
+# Global variables to keep track of statistics. These get updated by different
+# connection handler threads, so rather than plain numbers protected by a lock,
+# they are metrics (see metrics.py), which each thread can update without
+# contending with the others, like this:
+#     stats.request_time.observe(x, route)
+#     stats.num_errors.inc()
+# All of them can be seen at /metrics, in the Prometheus text format.
 class Statistics:
     def __init__(self):
-        self.total_connections = 0
-        self.active_connections = 0
-        self.num_requests = 0
-        self.num_errors = 0
-        self.tot_time = 0 # total time spent handling requests
-        self.avg_time = 0 # average time spent handling requests
-        self.max_time = 0 # max time spent handling a request
-        self.lock = threading.Condition()
+        self.total_connections = metrics.Counter("central_connections_total",
+                "Client connections accepted.")
+        self.active_connections = metrics.Gauge("central_active_connections",
+                "Client connections currently open.")
+        self.num_errors = metrics.Counter("central_http_errors_total",
+                "Responses with a code other than 200, 101, or 304.")
+        self.responses = metrics.Counter("central_http_responses_total",
+                "Responses sent, by code.", ("code",))
+        self.request_time = metrics.Histogram("central_http_request_duration_seconds",
+                "Time spent handling requests, by route.", ("route",))
+        self.analyses = metrics.Counter("central_analyses_total",
+                "Analysis requests, by how they were answered.", ("result",)) # hit, miss, coalesced, prefix
+        self.fanout_time = metrics.Histogram("central_analysis_fanout_seconds",
+                "Time from sending jobs to the workers until all replied or the deadline passed.")
+        self.jobs_sent = metrics.Counter("central_jobs_sent_total",
+                "Jobs sent to workers, by analysis phase.", ("phase",)) # all, coarse, fine
+        self.partial = metrics.Counter("central_analysis_partial_total",
+                "Analyses where some workers did not reply before the deadline.")
+        self.job_time = metrics.Histogram("central_worker_job_seconds",
+                "Time from sending a job to a worker until its reply arrived, by worker.", ("worker",))
+        self.probe_rtt = metrics.Histogram("central_worker_probe_rtt_seconds",
+                "Minimum rtt measured by each worker, by worker.", ("worker",),
+                buckets=(0.001, 0.0025, 0.005, 0.01, 0.02, 0.04, 0.08, 0.12, 0.16, 0.2, 0.3, 0.5, 1.0))
+        self.worker_errors = metrics.Counter("central_worker_job_errors_total",
+                "Jobs a worker could not do, by worker.", ("worker",))
+        self.evictions = metrics.Counter("central_worker_evictions_total",
+                "Times a worker was left out of the fan-out for bad health, by worker.", ("worker",))
+        self.batch_targets = metrics.Counter("central_batch_targets_total",
+                "Target urls received in /analyze_batch requests, by outcome.", ("result",)) # unique, duplicate, malformed
+        # These gauges are computed whenever /metrics is requested.
+        metrics.Gauge("central_analysis_cache_hit_ratio",
+                "Fraction of analyses answered without a fan-out of their own.",
+                func=self.cache_hit_ratio)
+        metrics.Gauge("central_workers", "Workers currently registered.",
+                func=lambda: len(workers))
+        metrics.Gauge("central_workers_healthy", "Registered workers healthy enough to be sent jobs.",
+                func=lambda: len(workers.healthy()))
+        metrics.Gauge("central_analyses_inflight", "Analyses waiting for workers.",
+                func=lambda: len(analyses))
+        metrics.Gauge("central_result_cache_entries", "Hosts with cached analysis results.",
+                func=lambda: len(result_cache))
+        metrics.Gauge("central_static_cache_entries", "Static files cached in memory.",
+                func=lambda: len(static_files))
+        metrics.Gauge("central_static_cache_bytes", "Bytes of static files cached in memory.",
+                func=lambda: static_files.total)
+
+    def cache_hit_ratio(self):
+        counts = self.analyses.collect()
+        total = sum(counts.values())
+        if total == 0:
+            return 0
+        return (counts.get(("hit",), 0) + counts.get(("coalesced",), 0) + counts.get(("prefix",), 0)) / total
 stats = Statistics()
 
 
+# Analysis objects hold the state for one target url being probed: the url,
+# the workers the job was sent to, and the results that have come back so far.
+# Each analysis has its own request ID, which is sent to the workers along with
+# the url and echoed back in their RESULT frames, so concurrent analyses never
+# see each other's results. Results are keyed by worker ID, and should only be
+# touched with the lock held.
+class Analysis:
+    def __init__(self, request_id, url, expected):
+        self.request_id = request_id # unique ID for this analysis
+        self.url = url               # target url being analyzed
+        self.expected = expected     # IDs of the workers we sent jobs to
+        self.results = {}            # worker ID -> (rtt summary, target ip)
+        self.started = time.time()   # when the jobs were sent
+        self.finished = None         # when the last expected result arrived
+        self.lock = threading.Condition()
+
+    # add_result() records one worker's answer and wakes up the waiting handler.
+    # The rtt summary is a tuple (min, median, p90) from measure.summarize(). A
+    # worker that failed to analyze the target reports summary None, and an
+    # error message in place of the ip.
+    def add_result(self, worker_id, summary, ip):
+        with self.lock:
+            self.results[worker_id] = (summary, ip)
+            if len(self.results) == len(self.expected):
+                self.finished = time.time()
+            self.lock.notify_all()
+
+    # wait() blocks until every expected worker has answered or until timeout
+    # seconds have passed, whichever comes first. It returns a copy of the
+    # results gathered so far.
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        with self.lock:
+            while len(self.results) < len(self.expected):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.lock.wait(remaining)
+            return dict(self.results)
+
+# All analyses that are currently waiting for results, keyed by request ID.
+analyses = {}
+analyses_lock = threading.Lock()
+next_request_id = itertools.count(1)
+
+# Recent analysis results, keyed by normalized target host. Each value is a
+# tuple (targets, results, estimate), exactly as run_analyses() returns it.
+result_cache = cache.TTLCache(cache_size, cache_ttl)
+
+# Locations estimated by completed analyses, by the ip prefix of the target, so
+# targets in the same address range can be located without any fan-out.
+prefix_index = prefixindex.PrefixIndex()
+
+# The target ip the best worker saw for each recently analyzed host, keyed by
+# normalized host, so a host can be looked up in prefix_index once its own
+# results have expired, without central resolving it (central could well get a
+# different answer from DNS than the workers). Entries are kept for
+# prefix_max_age seconds, which is set by the main program.
+target_ips = cache.TTLCache(prefixindex.max_entries, prefix_max_age)
+
+# Every rtt measurement a worker sends is appended to this store, so it can be
+# looked up later without probing the target again. It is None if measurements
+# are not being kept (see rtt_store_dir), and is opened by the main program.
+rtt_store = None
+
+# Static files from server_root, with their mime types, ETags, and compressed
+# copies, are kept in memory here.
+static_files = staticcache.StaticCache(server_root, static_cache_bytes, static_max_file_size)
+
+# Analyses currently being run, keyed by normalized target host. Each value is
+# a Future that will hold the (targets, results, estimate) once it is done,
+# so concurrent requests for the same host can share it.
+inflight = {}
+inflight_lock = threading.Lock()
+
+# Sending a job to a worker is done on this pool, so one slow or stuck worker
+# socket never holds up the jobs sent to the other workers.
+dispatch_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="dispatch")
+
+# In asyncio mode, request handlers run on this pool, off the event loop.
+handler_pool = ThreadPoolExecutor(max_workers=handler_threads, thread_name_prefix="handler")
+
+# The hosts in /analyze_batch requests are analyzed on this pool. Each request
+# keeps at most batch_concurrency groups of hosts queued or running on it at a
+# time.
+batch_pool = ThreadPoolExecutor(max_workers=batch_concurrency, thread_name_prefix="batch")
+
+
 # Request objects are used to hold information associated with a single HTTP
 # request from a client.
 class Request:
@@ -55,9 +233,10 @@ class Request:
         self.method = ""  # GET, POST, PUT, etc. for this request
         self.path = ""    # url path for this request
         self.version = "" # http version for this request
-        self.headers = [] # headers from client for this request
-        self.length = 0   # length of the request body, if any
+        self.headers = httpparse.Headers() # headers from client for this request
         self.body = None  # contents of the request body, if any
+        self.start = ""   # url path without the query, used for routing
+        self.query = ""   # query string from the url path, if any
 
 
 # Response objects are used to hold information associated with a single HTTP
@@ -65,150 +244,142 @@ class Request:
 # something like "200 OK" or "404 NOT FOUND". The mime_type and body are
 # options. If present, the mime_type should be something like "text/plain" or
 # "image/png", and the body should be a string or raw bytes object containing
-# contents appropriate for that mime type.
+# contents appropriate for that mime type. Any extra headers, like
+# "Upgrade: foo", can be given as a list of strings. Instead of a body, a
+# response can carry an open file (and its size), which is streamed straight
+# from the file to the client socket and closed once it has been sent, or a
+# generator of bytes objects, which are sent with chunked transfer encoding as
+# soon as each one is produced.
 class Response:
-    def __init__(self, code, mime_type=None, body=None):
+    def __init__(self, code, mime_type=None, body=None, headers=None):
         self.code = code
         self.mime_type = mime_type
         self.body = body
+        self.headers = headers or []
+        self.file = None      # open file to send as the body, if any
+        self.file_size = 0    # number of bytes to send from the file
+        self.chunks = None    # generator of body chunks to stream, if any
 
 
 # Connection objects are used to hold information associated with a single HTTP
-# connection socket, like the socket itself, statistics, any leftover data from
-# the client that hasn't yet been processed, etc.
+# connection socket, like the socket itself, statistics, a parser holding any
+# data from the client that hasn't yet been processed, etc.
 class Connection:
     def __init__(self, c, addr):
         self.sock = c             # the socket connected to the client
         self.client_addr = addr   # address of the client
-        self.leftover_data = b""  # data from client, not yet processed
+        self.parser = httpparse.RequestParser() # parses data from the client
         self.num_requests = 0     # number of requests from client handled so far
+        self.worker_info = None   # (location, coords) if a worker registered here
+        self.route = None         # route taken by the current request
+        self.started = None       # when the current request arrived
         #can try keepalive header here
 
-    # read_until_blank_line() returns data from the client up to (but not
-    # including) the next blank line, i.e. "\r\n\r\n". The "\r\n\r\n" sequence
-    # is discarded. Any leftovers after the blank line is saved for later. This
-    # function returns None if an error is encountered.
-    def read_until_blank_line(self):
-        data = self.leftover_data
+    # fill() reads (up to) another 64KB of data from the client and feeds it to
+    # the parser. It returns False if the connection has died, or an error is
+    # encountered.
+    def fill(self):
         try:
-            while b"\r\n\r\n" not in data:
-                # Read (up to) another 4KB of data from the client
-                more_data = self.sock.recv(4096)
-                if not more_data: # Connection has died?
-                    self.leftover_data = data # save it all for later
-                    return None
-                data = data + more_data
-            # The part we want is everything up to the first blank line.
-            data, self.leftover_data = data.split(b"\r\n\r\n", 1)
-            return data.decode()
-        except:
-            log("Error reading from client %s socket" % (self.client_addr))
-            self.leftover_data = data # save it all for later
-            return None
-
-    # read_amount(n) returns the next n bytes of data from the client. Any
-    # leftovers after the n bytes are saved for later. This function returns
-    # None if an error is encountered.
-    def read_amount(self, n):
-        data = self.leftover_data
-        try:
-            while len(data) < n:
-                more_data = self.sock.recv(n - len(data))
-                if not more_data: # Connection has died?
-                    self.leftover_data = data # save it all for later
-                    return None
-                data = data + more_data
-            # The part we want is the first n bytes.
-            data, self.leftover_data = (data[0:n], data[n:])
-            return data.decode()
-        except:
-            log("Error reading from client %s socket" % (self.client_addr))
-            self.leftover_data = data # save it all for later
-            return None
-
-
-# log(msg) prints a message to standard output. Since multi-threading can jumble
-# up the order of output on the screen, we print out the current thread's name
-# on each line of output along with the message.
+            data = self.sock.recv(65536)
+        except OSError:
+            log("Error reading from client %s socket", self.client_addr)
+            return False
+        self.parser.feed(data)
+        return len(data) > 0
+
+    # read_request_head() returns the request-line and headers of the next
+    # request from the client, as an httpparse.RequestHead. Any data after them
+    # stays in the parser for later. This function returns None if the
+    # connection dies first, and raises httpparse.HTTPError if the request is
+    # malformed or too big.
+    def read_request_head(self):
+        while True:
+            head = self.parser.parse_head()
+            if head is not None:
+                return head
+            if not self.fill():
+                return None
+
+    # read_body() returns the body of the current request, decoded to a string.
+    # Chunked bodies are decoded as the chunks arrive. This function returns
+    # None if the connection dies first, and raises httpparse.HTTPError if the
+    # body is malformed or too big.
+    def read_body(self):
+        parts = []
+        while True:
+            parts.append(self.parser.read_body())
+            if self.parser.body_done:
+                return b"".join(parts).decode(errors="replace")
+            if not self.fill():
+                return None
+
+
+# log(msg) logs an informational message. Messages are written to standard
+# output by logutil's background writer thread, prefixed with the name of the
+# thread that logged them, so the order of output doesn't get jumbled up. Any
+# extra args are formatted into msg by the writer thread, as in msg % args.
 # Example usage:
-#   log("Hello %s, you are customer number %d, have a nice day!" % (name, n))
-def log(msg):
-    # Convert msg to a string, if it is not already
-    if not isinstance(msg, str):
-        msg = str(msg)
-    # Each python thread has a name. Use current thread's in the output message.
-    myname = threading.current_thread().name
-    # When printing multiple lines, indent each line a bit
-    indent = (" " * len(myname))
-    linebreak = "\n" + indent + ": "
-    lines = msg.splitlines()
-    msg = linebreak.join(lines)
-    # Print it all out, prefixed by this thread's name.
-    print(myname + ": " + msg)
-
-
-# get_header_value() finds a specific header value from within a list of header
-# key-value pairs. If the requested key is not found, None is returned instead.
-# The headers list comes from an HTTP request sent from the client. The key
-# should usually be a standard HTTP header, like "Content-Type",
-# "Content-Length", "Connection", etc.
-def get_header_value(headers, key):
-    for hdr in headers:
-        if hdr.lower().startswith(key.lower() + ": "):
-            val = hdr.split(" ", 1)[1]
-            return val
-    return None
+#   log("Hello %s, you are customer number %d, have a nice day!", name, n)
+def log(msg, *args):
+    logutil.info(msg, *args)
 
 
 # make_printable() does some conversions on a string so that it prints nicely
 # on the console while still showing unprintable characters (like "\r") in 
 # a sensible way.
+# This is slow, so it should only be used through logutil.Lazy() for debug
+# messages.
 printable = string.ascii_letters + string.digits + string.punctuation + " \r\n\t"
+unprintable = re.compile("[^" + re.escape(printable) + "]")
 def make_printable(s):
     s = s.replace("\n", "\\n\n")
     s = s.replace("\t", "\\t")
     s = s.replace("\r", "\\r")
-    s = s.replace("\r", "\\r")
-    return ''.join(c if c in printable else r'\x{0:02x}'.format(ord(c)) for c in s)
+    return unprintable.sub(lambda m: r'\x{0:02x}'.format(ord(m.group())), s)
 
 # handle_one_http_request() reads one HTTP request from the client, parses it,
 # decides what to do with it, then sends an appropriate response back to the
-# client. 
+# client. It returns the name of the route the request took (see
+# handle_http_request()), or None if no request could be read. The time the
+# request arrived is left in conn.started.
 def handle_one_http_request(conn):
-   
-    # The HTTP request is everything up to the first blank line
-    data = conn.read_until_blank_line()
-    if data == None:
-        return # something is wrong, maybe connection was closed by client?
+    conn.route = "invalid"
+    conn.started = time.time()
+    try:
+        head = conn.read_request_head()
+        if head is None:
+            return None # something is wrong, maybe connection was closed by client?
+        conn.started = time.time() # don't count time spent idle, waiting for the request
+        req = parse_http_request(conn, head)
+        # If request has a body, get the body of the request.
+        if not conn.parser.body_done:
+            req.body = conn.read_body()
+            if req.body is None:
+                return None # connection was closed partway through the body
+        resp = handle_http_request(req, conn)
+    except httpparse.HTTPError as e:
+        resp = http_error_response(conn, e)
 
-    log("Request %d has arrived...\n%s" % (conn.num_requests, make_printable(data+"\r\n\r\n")))
+    # Now send the response to the client.
+    send_http_response(conn, resp)
+    return conn.route
+
+# parse_http_request() turns the request-line and headers sent by the client,
+# as parsed by httpparse, into a Request object. Reading the body, if any, is
+# left to the caller, since that depends on the server mode.
+def parse_http_request(conn, head):
+    logutil.debug("Request %d has arrived...\n%s", conn.num_requests,
+            logutil.Lazy(make_printable, head.raw.decode("latin-1") + "\r\n\r\n"))
 
     # Make a Request object to hold all the info about this request
     req = Request()
+    req.method = head.method
+    req.path = head.target
+    req.version = head.version
+    req.headers = head.headers
 
-    # The first line is the request-line, the rest is the headers.
-    lines = data.splitlines()
-    if len(lines) == 0:
-        log("Request is missing the required HTTP request-line")
-        resp = Response("400 BAD REQUEST", "text/plain", "You need a request-line!")
-        send_http_response(conn, resp)
-        return
-    request_line = lines[0]
-    req.headers = lines[1:]
-
-    # The request-line can be further split into method, path, and version.
-    words = request_line.split()
-    if len(words) != 3:
-        log("The request-line is malformed: '%s'" % (request_line))
-        resp = Response("400 BAD REQUEST", "text/plain", "Your request-line is malformed!")
-        send_http_response(conn, resp)
-        return
-    req.method = words[0]
-    req.path = words[1]
-    req.version = words[2]
-
-    log("Request has method=%s, path=%s, version=%s, and %d headers" % (
-        req.method, req.path, req.version, len(req.headers)))
+    logutil.debug("Request has method=%s, path=%s, version=%s, and %d headers", 
+        req.method, req.path, req.version, len(req.headers))
 
     # The path will look like either "/foo/bar" or "/foo/bar?key=val&baz=boo..."
     # Unmangle any '%'-signs in the path, but just the part before any '?'-mark
@@ -219,297 +390,934 @@ def handle_one_http_request(conn):
     else:
         req.path = urllib.parse.unquote(req.path)
 
-    # Browsers that use chunked transfer encoding are tricky, don't bother.
-    if get_header_value(req.headers, "Transfer-Encoding") == "chunked":
-        log("The request uses chunked transfer encoding, which isn't yet supported")
-        resp = Response("411 LENGTH REQUIRED", "text/plain", "Your request uses chunked tranfer encoding, sorry!")
-        send_http_response(conn, resp)
-        return
-
-    # If request has a Content-Length header, get the body of the request.
-    
-    n = get_header_value(req.headers, "Content-Length")
-    if n is not None:
-        req.length = int(n)
-        req.body = conn.read_amount(int(n))
-
-    keep_check = get_header_value(req.headers, "Connection").lower()
-    if  keep_check == "keep-alive":
-        conn.keepAlive = True
+    # HTTP/1.1 connections stay open unless the client asks to close them, so
+    # that clients can send (and pipeline) more requests on them.
+    keep_check = req.headers.get("Connection", "").lower()
+    if req.version == "HTTP/1.1":
+        conn.keepAlive = keep_check != "close"
     else:
-        conn.keepAlive = False
-      
-    # Finally, look at the method and path to decide what to do.
-    if req.method == "GET":
-        resp = handle_http_get(req,conn)
-    elif req.method == "POST":
-        resp = handle_http_post(req)
+        conn.keepAlive = keep_check == "keep-alive"
+    return req
+
+# http_error_response() returns the response to send back when the parser
+# rejects a request, e.g. because it is malformed or too big. The connection is
+# closed afterwards, since there is no telling where the next request starts.
+def http_error_response(conn, e):
+    log("Bad request from %s: %s", conn.client_addr, e.msg)
+    conn.keepAlive = False
+    return Response(e.code, "text/plain", e.msg)
+
+# handle_http_request() looks at the method and path of a fully-read request to
+# decide what to do, and returns the response to send back to the client. The
+# name of the route taken is saved as conn.route, for the statistics.
+def handle_http_request(req, conn):
+    req.start, _, req.query = req.path.partition('?') #finds path before variables
+    req.start = req.start.split('=')[0]
+    route, handler = find_route(req.method, req.start)
+    conn.route = route or "unmatched"
+    if handler is not None:
+        resp = handler(req, conn)
+    elif req.method == "GET":
+        conn.route = "static"
+        resp = handle_http_get(req, conn)
+    elif req.method in routes:
+        resp = Response("404 NOT FOUND", "text/plain", "No such resource: " + req.path)
     else:
-        log("Method '%s' is not recognized or not yet implemented" % (req.method))
+        log("Method '%s' is not recognized or not yet implemented", req.method)
         resp = Response("405 METHOD NOT ALLOWED",
                 "text/plain",
                 "Unrecognized method: " + req.method)
-
-    # Now send the response to the client.
-    send_http_response(conn, resp)
+    return resp
     
 # send_http_response() sends an HTTP response to the client. The response code
 # should be something like "200 OK" or "404 NOT FOUND". The mime_type and body
-# are sent as the contents of the response.
+# are sent as the contents of the response. The headers and body go out in a
+# single sendmsg() call, while a file body is sent with sendfile(), so it never
+# has to be read into memory. A streamed body is sent one chunk at a time.
 def send_http_response(conn, resp):
+    head, body = format_http_response(conn, resp)
+    if body is not None:
+        conn.sock.sendmsg_all([head, body])
+    else:
+        conn.sock.sendall(head)
+    if resp.file is not None:
+        try:
+            conn.sock.sendfile(resp.file, 0, resp.file_size)
+        finally:
+            resp.file.close()
+    if resp.chunks is not None:
+        try:
+            for chunk in resp.chunks:
+                if len(chunk) > 0:
+                    conn.sock.sendmsg_all(frame_chunk(chunk))
+            conn.sock.sendall(b"0\r\n\r\n")
+        finally:
+            resp.chunks.close()
+
+# frame_chunk() returns the buffers to send for one chunk of a response sent
+# with chunked transfer encoding. The chunk must not be empty, since an empty
+# chunk marks the end of the body.
+def frame_chunk(chunk):
+    return [b"%x\r\n" % len(chunk), chunk, b"\r\n"]
+
+# format_http_response() builds the response-line, headers, and body for a
+# response, and returns them as a pair of raw bytes objects (the body is None if
+# there isn't one, or if it comes from resp.file). Both server modes use this
+# to do the actual formatting.
+def format_http_response(conn, resp):
  
-    # If this is anything other than code 200, tally it as an error.
-    if not resp.code.startswith("200 "):
-        with stats.lock: # update overall server statistics
-            stats.num_errors += 1
+    # If this is anything other than code 200 (or 101 or 304), tally it as an error.
+    if not resp.code.startswith(("200 ", "101 ", "304 ")):
+        stats.num_errors.inc()
+    stats.responses.inc(1, resp.code.split(" ", 1)[0])
     # Make a response-line and all the necessary headers.
-    data = "HTTP/1.1 " + resp.code + "\r\n"
-    data += "Server: csci356\r\n"
-    data += "Date: " + time.strftime("%a, %d %b %Y %H:%M:%S %Z") + "\r\n"
+    lines = ["HTTP/1.1 " + resp.code,
+             "Server: csci356",
+             "Date: " + email.utils.formatdate(usegmt=True)]
+    lines.extend(resp.headers)
 
     body = None
-    if resp.mime_type == None:
-        data += "Content-Length: 0\r\n"
+    if resp.code.startswith("101 "):
+        pass # switching protocols, there is no body at all
     else:
-        if isinstance(resp.body, bytes):   # if response body is raw binary...
-            body = resp.body               # ... no need to encode it
-        elif isinstance(resp.body, str):   # if response body is a string...
-            body = resp.body.encode()      # ... convert to raw binary
-        else:                              # if response body is anything else...
-            body = str(resp.body).encode() # ... convert it to raw binary
-        data += "Content-Type: " + resp.mime_type + "\r\n"
-        data += "Content-Length: " + str(len(body)) + "\r\n"
+        if resp.code.startswith("304 "):
+            pass # not modified, there is no body at all
+        elif resp.file is not None:
+            lines.append("Content-Type: " + resp.mime_type)
+            lines.append("Content-Length: " + str(resp.file_size))
+        elif resp.chunks is not None:
+            lines.append("Content-Type: " + resp.mime_type)
+            lines.append("Transfer-Encoding: chunked")
+        elif resp.mime_type == None:
+            lines.append("Content-Length: 0")
+        else:
+            if isinstance(resp.body, bytes):   # if response body is raw binary...
+                body = resp.body               # ... no need to encode it
+            elif isinstance(resp.body, str):   # if response body is a string...
+                body = resp.body.encode()      # ... convert to raw binary
+            else:                              # if response body is anything else...
+                body = str(resp.body).encode() # ... convert it to raw binary
+            lines.append("Content-Type: " + resp.mime_type)
+            lines.append("Content-Length: " + str(len(body)))
         if conn.keepAlive is True:
-            data += "Connection: keep-alive\r\n" #trying keepalive stuff here
+            lines.append("Connection: keep-alive") #trying keepalive stuff here
         else: 
-            data += "Connection: close\r\n"
-    data += "\r\n"
-
-    # Send response-line, headers, and body
-    log("Sending response-line and headers...\n%s" % (make_printable(data)))
-    conn.sock.sendall(data.encode())
-    if body is not None:
-        log("Response body (not shown) has %d bytes, mime type '%s'" % (len(body), resp.mime_type))
-        conn.sock.sendall(body)
-
-
-
+            lines.append("Connection: close")
+    lines.append("\r\n")
+    data = "\r\n".join(lines)
+
+    if logutil.enabled(logutil.DEBUG):
+        logutil.debug("Sending response-line and headers...\n%s", logutil.Lazy(make_printable, data))
+        if body is not None:
+            logutil.debug("Response body (not shown) has %d bytes, mime type '%s'", len(body), resp.mime_type)
+        elif resp.file is not None:
+            logutil.debug("Response body (not shown) is a %d byte file, mime type '%s'", resp.file_size, resp.mime_type)
+    return data.encode(), body
+
+# record_request_stats() updates the overall server statistics after a request
+# has been handled, given the route it took and the time it took in seconds.
+def record_request_stats(route, duration):
+    stats.request_time.observe(duration, route)
+
+
+
+
+# The html pages are compiled into templates once, at startup, so that handling
+# a request only has to fill in the parts that change.
+hello_template = template.Template(
+    "<html><head><title>Hello World!</title></head>"
+    "<body style = background-color:{{bgcolor}}>"
+    "<h1>Hello {{username}} hit page refresh (F5) to refresh this page, <br>"
+    "though the contents will never change, sadly.</h1><br> "
+    "<p> You can also go to these exciting pages:<br>"
+    "</p></body></html>")
+
+index_page = template.Template(
+    "<html><head><title>Geolocation Service</title></head>"
+    "<body>"
+    "<h3>Welcome to Kevin's, Tim's, and Liam's geolocation service</h3>"
+    "<p></p>"
+    "<p></p>"
+    "<form action='/analyze' method='GET'>"
+    "Enter a url and we will try estimate its physical location (HTTPS is not supported yet, only HTTP so far, sorry):<br>"
+    "<input type='text' name='target' size='80' value='http://www.google.com/'>"
+    "<input type='submit'>"
+    "</form>"
+    "</p>"
+    "</body></html>").render()
+
+location_page_body = template.Template(
+    "<html><head><title>Geolocation Service</title></head>"
+    "<body>"
+    "<h3>Kevin, Tim, and Liam are trying to estimate your location</h3>"
+    "<p> We'll do something with our workers RTTs and give you an estimate soon</p>"
+    "</body></html>").render()
+
+analyze_template = template.Template(
+    "<html><head><title>Geolocation Service</title></head>"
+    "<body>"
+    "<h3>Kevin, Tim, and Liam are trying to find your link</h3>"
+    "<form action='/analyze' method='GET'>"
+    "Enter a url (HTTPS is not supported yet, only HTTP so far, sorry):<br>"
+    "<input type='text' name='target' size='80'>"
+    "<input type='submit'>"
+    "</form>"
+    "{{rows}}"
+    "</body></html>")
+partial_row = template.Template(
+    "<p>Partial results: {{replied}} of {{total}} workers replied within {{deadline}} seconds</p>")
+failed_row = template.Template(
+    "<h2> The worker at {{loc}} {{co}} could not reach the target: {{error}}</h2>")
+rtt_row = template.Template(
+    "<h2> The RTT from {{loc}} {{co}} is: min {{low}} ms, median {{median}} ms, p90 {{p90}} ms ({{mode}})</h2>")
+missing_row = template.Template(
+    "<h2> No reply from {{loc}} {{co}} before the deadline</h2>")
+best_row = template.Template(
+    "<h2> Based on the minimum RTT, your location is at {{loc}} with coordinates {{co}}  and IP {{ip}} </h2>")
+prefix_row = template.Template(
+    "<p>Not probed: the target's IP {{ip}} is in {{prefix}}, which was located {{age}} seconds ago "
+    "by {{workers}} workers</p>")
+estimate_row = template.Template(
+    "<h2> By multilateration, your location is near ({{lat}}, {{lon}}), give or take {{radius}} km"
+    " ({{km}} km from the {{region}} datacenter in {{city}})</h2>")
 
 # handle_http_get_hello() returns a response for GET /hello
-def handle_http_get_hello(bgcolor, username):
+def handle_http_get_hello(req, conn):
+    bgcolor = "#"+''.join([random.choice('0123456789ABCDEF') for j in range(6)]) #random hex color
+    username = req.path.split('=')[-1]
     if username == "/hello": #if no username 
         username = ""
-    msg = "<html><head><title>Hello World!</title></head>"
-    msg += "<body style = background-color:%s>" % bgcolor
-    msg += '<h1>Hello %s hit page refresh (F5) to refresh this page, <br>'% username
-    msg += 'though the contents will never change, sadly.</h1><br> '
-    msg += '<p> You can also go to these exciting pages:<br>' 
-    msg += "</p></body></html>"
-
+    msg = hello_template.render(bgcolor=bgcolor, username=username)
     return Response("200 OK", "text/html", msg)
 
-def http_get_index():
-    msg = "<html><head><title>Geolocation Service</title></head>"
-    msg += "<body>" 
-    msg += "<h3>Welcome to Kevin's, Tim's, and Liam's geolocation service</h3>"
-    msg += "<p></p>"
-    msg += "<p></p>"
-    msg += "<form action='/analyze' method='GET'>"
-    msg += "Enter a url and we will try estimate its physical location (HTTPS is not supported yet, only HTTP so far, sorry):<br>"
-    msg += "<input type='text' name='target' size='80' value='http://www.google.com/'>"
-    msg += "<input type='submit'>"
-    msg += "</form>"
-    msg += "</p>"
-    msg += "</body></html>"
+def http_get_index(req, conn):
+    return Response("200 OK", "text/html", index_page)
 
-    return Response("200 OK", "text/html", msg)
+# http_get_metrics() returns all the server statistics, in the Prometheus text
+# format.
+def http_get_metrics(req, conn):
+    return Response("200 OK", metrics.CONTENT_TYPE, metrics.render())
 
 
 def location_page(): #def location_page(rtt_list):
-    msg = "<html><head><title>Geolocation Service</title></head>"
-    msg += "<body>" 
-    msg += "<h3>Kevin, Tim, and Liam are trying to estimate your location</h3>"
-    msg += "<p> We'll do something with our workers RTTs and give you an estimate soon</p>"
-    msg += "</body></html>"
-
-    return Response("200 OK", "text/html", msg)
-
-# send msg to each worker containing url
-# recv msg conatining result from each worker
-# join results together into single page
+    return Response("200 OK", "text/html", location_page_body)
+
+# send_jobs() sends one JOB frame to one worker, asking it to probe each url in
+# jobs, a list of (request ID, url) pairs. Errors are logged and otherwise
+# ignored, the worker will simply show up as not having replied.
+def send_jobs(worker, jobs, samples):
+    for (request_id, url) in jobs:
+        worker.health.job_sent(request_id)
+    try:
+        worker.channel.send_jobs(jobs, measure_mode, samples)
+    except:
+        log("Error sending %d jobs to worker at %s", len(jobs), worker.location)
+        for (request_id, url) in jobs:
+            worker.health.send_failed(request_id)
+
+# fan_out() has workers probe urls, and waits until every worker answered or
+# deadline seconds have passed. The plan maps each url to the list of target
+# workers that should probe it. Each url gets an analysis with a new request ID,
+# and each worker is sent a single JOB frame listing all the urls it should
+# probe, however many there are. It returns a dict mapping each url to a dict,
+# which maps the ID of each worker that replied to (rtt summary, target ip).
+# Workers that don't reply in time are simply left out; a slow target isn't
+# held against them, only a job they never answer at all is (see
+# heartbeat_loop()).
+def fan_out(plan, samples, deadline, phase):
+    pending = {} # url -> Analysis
+    jobs = {}    # worker ID -> (worker, [(request ID, url), ...])
+    for (url, targets) in plan.items():
+        if len(targets) == 0:
+            continue
+        analysis = Analysis(next(next_request_id), url, [w.id for w in targets])
+        pending[url] = analysis
+        for worker in targets:
+            jobs.setdefault(worker.id, (worker, []))[1].append((analysis.request_id, url))
+    found = {url: {} for url in plan}
+    if len(pending) == 0:
+        return found
+    start = time.time()
+    with analyses_lock:
+        for analysis in pending.values():
+            analyses[analysis.request_id] = analysis
+    try:
+        for (worker, worker_jobs) in jobs.values():
+            dispatch_pool.submit(send_jobs, worker, worker_jobs, samples)
+        stats.jobs_sent.inc(sum(len(a.expected) for a in pending.values()), phase)
+        for (url, analysis) in pending.items():
+            found[url] = analysis.wait(max(0.0, deadline - (time.time() - start)))
+            stats.fanout_time.observe((analysis.finished or time.time()) - analysis.started)
+            if len(found[url]) < len(analysis.expected):
+                stats.partial.inc()
+    finally:
+        with analyses_lock:
+            for analysis in pending.values():
+                del analyses[analysis.request_id]
+    return found
+
+# spread_out() picks up to n workers that are as far apart from each other as
+# possible, by farthest-point sampling: starting from the first worker, it
+# repeatedly adds the worker farthest from all the ones picked so far. Distances
+# between workers are those between their regions, from the precomputed
+# regionindex.distance_matrix. Once every worker left shares a region with one
+# already picked, it stops, so it may pick fewer than n.
+def spread_out(candidates, n):
+    if len(candidates) <= n:
+        return list(candidates)
+    picked = [candidates[0]]
+    gap = [regionindex.region_distance(w.region, candidates[0].region) for w in candidates]
+    gap[0] = -1 # already picked
+    while len(picked) < n:
+        i = max(range(len(candidates)), key=lambda j: gap[j])
+        if gap[i] <= 0:
+            break
+        picked.append(candidates[i])
+        gap[i] = -1
+        for j, w in enumerate(candidates):
+            if gap[j] > 0:
+                gap[j] = min(gap[j], regionindex.region_distance(w.region, candidates[i].region))
+    return picked
+
+# nearest_workers() returns the n workers closest to a point, closest first. It
+# asks regionindex for the regions nearest the point, twice as many each time,
+# until there are n workers in them, so it never has to look at the regions
+# far away from the point.
+def nearest_workers(candidates, lat, lon, n):
+    by_region = {} # region -> the workers in it
+    for w in candidates:
+        by_region.setdefault(w.region, []).append(w)
+    k = max(1, n)
+    while True:
+        near = regionindex.nearest(lat, lon, k)
+        picked = [w for (km, region) in near for w in by_region.get(region, [])]
+        if len(picked) >= n or len(near) < k:
+            return picked[:n]
+        k *= 2
+
+# run_analyses() works out which healthy workers should probe each of urls, has
+# them do it, and waits for their answers, for at most analyze_deadline
+# seconds. All the urls are probed at once, in a single fan-out, so each worker
+# gets one JOB frame per phase no matter how many urls there are. It returns a
+# list with a tuple (targets, results, estimate) for each url, where targets is
+# the list of workerregistry.Worker records for the workers jobs were sent to,
+# results maps the ID of each worker that replied to (rtt summary, target ip),
+# and estimate is the target's estimated location, from estimate_location().
+# The estimate is only worked out here, once per analysis, and travels with the
+# results from then on.
+#
+# With select_mode "all", every healthy worker probes every target at once.
+# With select_mode "adaptive", a few spread-out workers first take a quick
+# coarse measurement, which gives a rough estimate of where each target is, and
+# then only the workers nearest that estimate take the full measurement. That
+# keeps the number of jobs per analysis the same no matter how many workers
+# there are. Workers that only took part in the coarse phase keep their coarse
+# results.
+def run_analyses(urls):
+    # workers.healthy() is a snapshot, so registrations during the analysis
+    # don't change who we are waiting for.
+    candidates = workers.healthy()
+    if select_mode != "adaptive" or estimator is None or len(candidates) <= coarse_workers + fine_workers:
+        found = fan_out({url: candidates for url in urls}, measure_samples, analyze_deadline, "all")
+        return [(candidates, found[url], estimate_location(candidates, found[url])) for url in urls]
+
+    start = time.time()
+    coarse = spread_out(candidates, coarse_workers)
+    found = fan_out({url: coarse for url in urls}, coarse_samples,
+            min(coarse_deadline, analyze_deadline), "coarse")
+    fine = {} # url -> the workers nearest its coarse estimate
+    for url in urls:
+        est = estimate_location(coarse, found[url])
+        # If nobody could reach the target, the other workers won't either.
+        if est is not None:
+            fine[url] = nearest_workers(candidates, est[0], est[1], fine_workers)
+    remaining = max(0.0, analyze_deadline - (time.time() - start))
+    for (url, results) in fan_out(fine, measure_samples, remaining, "fine").items():
+        found[url].update(results)
+
+    done = []
+    for url in urls:
+        if url not in fine:
+            done.append((coarse, found[url], None))
+        else:
+            targets = fine[url] + [w for w in coarse if w not in fine[url]]
+            done.append((targets, found[url], estimate_location(targets, found[url])))
+    return done
+
+# locate_host() finds out where the host of url is, the cheapest way it can:
+# from its own cached results if they are recent enough, from prefix_index, or
+# else by analyzing it. It returns a pair (hit, analysis), exactly one of which
+# is None, where hit is a tuple (ip, prefix, prefixindex.Location) as returned
+# by lookup_prefix(), and analysis is a tuple (targets, results, estimate). It
+# raises ValueError if url has no host.
+def locate_host(url):
+    key = urlutil.normalize_host(url)
+    hit, analysis = lookup_host(key, url)
+    if hit is None and analysis is None:
+        analysis = analyze_hosts([(key, url)])[0]
+    return hit, analysis
+
+# lookup_host() is like locate_host(), for url whose normalized host is key,
+# except that it never analyzes the host: if it would have to, it returns
+# (None, None).
+def lookup_host(key, url):
+    cached = result_cache.get(key)
+    if cached is not None:
+        stats.analyses.inc(1, "hit")
+        return None, cached
+    return lookup_prefix(key, url), None
+
+# analyze_hosts() returns a list with the (targets, results, estimate) for each
+# of hosts, a list of (normalized host, url) pairs for different hosts, from
+# fresh analyses, all run together by run_analyses(). If an analysis of one of
+# the hosts is already in flight, we wait for it and share its results rather
+# than sending another set of jobs to the workers. Only analyses where at least
+# one worker measured an rtt are cached.
+def analyze_hosts(hosts):
+    futures = {} # host -> Future for its analysis
+    mine = []    # (host, url) for the hosts we have to analyze ourselves
+    with inflight_lock:
+        for (key, url) in hosts:
+            future = inflight.get(key)
+            if future is None:
+                future = Future()
+                inflight[key] = future
+                mine.append((key, url))
+            futures[key] = future
+    stats.analyses.inc(len(hosts) - len(mine), "coalesced")
+    stats.analyses.inc(len(mine), "miss")
+
+    if len(mine) > 0:
+        try:
+            done = run_analyses([url for (key, url) in mine])
+            for ((key, url), analysis) in zip(mine, done):
+                remember_prefix(key, *analysis)
+                if any(summary is not None for (summary, ip) in analysis[1].values()):
+                    result_cache.put(key, analysis)
+                futures[key].set_result(analysis)
+        except BaseException as e:
+            for (key, url) in mine:
+                if not futures[key].done():
+                    futures[key].set_exception(e)
+            raise
+        finally:
+            with inflight_lock:
+                for (key, url) in mine:
+                    del inflight[key]
+    return [futures[key].result() for (key, url) in hosts]
+
+# remember_prefix() adds the location estimated from an analysis of the host
+# key to prefix_index, under the prefix of the target ip that the best worker
+# saw, and remembers that ip for the host in target_ips.
+def remember_prefix(key, targets, results, est):
+    best = best_worker(targets, results)
+    if best is None or est is None:
+        return
+    measured = sum(1 for (summary, ip) in results.values() if summary is not None)
+    prefix_index.add(results[best.id][1], est[0], est[1], est[2], measured)
+    target_ips.put(key, results[best.id][1])
+
+# lookup_prefix() looks up the ip of url, whose normalized host is key, in
+# prefix_index. It returns a tuple (ip, prefix, prefixindex.Location) if a
+# location for the ip's prefix was estimated in the last prefix_max_age seconds,
+# with a radius of at most prefix_max_radius, or None if the target needs to be
+# probed. The ip is only known if the url has an ip address for its host, or if
+# a worker reported one for the host recently (see target_ips). Host names are
+# never resolved here: that would hold up the request, and could give a
+# different answer than the workers get.
+def lookup_prefix(key, url):
+    if prefix_max_age <= 0:
+        return None
+    try:
+        ip = str(ipaddress.ip_address(urlutil.host_name(url)))
+    except ValueError:
+        ip = target_ips.get(key)
+    if ip is None:
+        return None
+    hit = prefix_index.lookup(ip, prefix_max_age)
+    if hit is None or hit[1].radius_km > prefix_max_radius:
+        return None
+    stats.analyses.inc(1, "prefix")
+    return (ip,) + hit
+
+# parse_coords() turns coordinates as sent by a worker, like "(-33.93, 18.42)",
+# into a (lat, lon) pair of floats.
+def parse_coords(co):
+    lat, lon = co.strip("()").split(",")
+    return float(lat), float(lon)
+
+# estimate_location() multilaterates the target's location from the minimum
+# rtt each worker measured, returning a tuple (lat, lon, radius_km), or None if
+# no worker measured anything or numpy isn't available.
+def estimate_location(targets, results):
+    coords, rtts = [], []
+    for worker in targets:
+        if worker.id in results and results[worker.id][0] is not None:
+            coords.append(worker.latlon)
+            rtts.append(results[worker.id][0][0])
+    if estimator is None or len(coords) == 0:
+        return None
+    return estimator.estimate(coords, rtts)
+
+# best_worker() returns the worker that measured the lowest minimum rtt, or None
+# if no worker measured anything.
+def best_worker(targets, results):
+    best = None
+    for worker in targets:
+        if worker.id in results and results[worker.id][0] is not None and (best is None or results[worker.id][0][0] < results[best.id][0][0]):
+            best = worker
+    return best
+
+# analyze the url from each worker (or from the cache, or the prefix index)
+# join results together into single page, labeling missing workers
 # msg = combined results
-def http_get_analyze(path,conn,req):
-    global location
-    global avg_rtt
-    global workers
-    global coord
-    global ips
-    
-    url = urllib.parse.unquote(path.split('=')[1])
+def http_get_analyze(req, conn):
+    url = urllib.parse.parse_qs(req.query).get("target", [""])[0]
 
-    #trying to send a message to all workers
+    targets, results, est = [], {}, None
     if len(url) != 0:
-        for i in workers: 
-            i.sendall(url + "\n")
-           
-    min_rtt = 100000
-
-    msg = "<html><head><title>Geolocation Service</title></head>"
-    msg += "<body>" 
-    msg += "<h3>Kevin, Tim, and Liam are trying to find your link</h3>"
-    msg += "<form action='/analyze' method='GET'>"
-    msg += "Enter a url (HTTPS is not supported yet, only HTTP so far, sorry):<br>"
-    msg += "<input type='text' name='target' size='80'>"
-    msg += "<input type='submit'>"
-    msg += "</form>"
+        try:
+            hit, analysis = locate_host(url)
+            if hit is not None:
+                return prefix_page(*hit)
+            targets, results, est = analysis
+        except ValueError:
+            return Response("400 BAD REQUEST", "text/plain", "Malformed target url: " + url)
+
+    rows = []
+    if len(results) < len(targets):
+        rows.append(partial_row.render(replied=len(results), total=len(targets), deadline=analyze_deadline))
+    for worker in targets:
+        loc, co = worker.location, worker.coords
+        if worker.id in results and results[worker.id][0] is None:
+            rows.append(failed_row.render(loc=loc, co=co, error=results[worker.id][1]))
+        elif worker.id in results:
+            low, median, p90 = ("%.1f" % (1000 * t) for t in results[worker.id][0])
+            rows.append(rtt_row.render(loc=loc, co=co, low=low, median=median, p90=p90, mode=measure_mode))
+        else:
+            rows.append(missing_row.render(loc=loc, co=co))
+
+    #calc min rtt from this analysis' results
+    best = best_worker(targets, results)
+    if best is not None:
+        rows.append(best_row.render(loc=best.location, co=best.coords, ip=results[best.id][1]))
+    if est is not None:
+        rows.append(render_estimate_row(est))
+
+    return Response("200 OK", "text/html", analyze_template.render(rows=b"".join(rows)))
+
+# render_estimate_row() renders the row for an estimated location (lat, lon,
+# radius_km), along with the nearest cloud region.
+def render_estimate_row(est):
+    (km, region) = regionindex.nearest(est[0], est[1])[0]
+    return estimate_row.render(lat="%.2f" % est[0], lon="%.2f" % est[1], radius="%d" % est[2],
+            km="%d" % km, region=region, city=cloud.region_cities[region])
+
+# prefix_page() returns the /analyze page for a target whose location was
+# found in prefix_index, without probing it.
+def prefix_page(ip, prefix, loc):
+    rows = [prefix_row.render(ip=ip, prefix=prefix, age="%d" % (time.time() - loc.updated),
+                workers=loc.workers),
+            render_estimate_row((loc.lat, loc.lon, loc.radius_km))]
+    return Response("200 OK", "text/html", analyze_template.render(rows=b"".join(rows)))
+
+# analysis_record() summarizes the results of one analysis as a dict, ready to
+# be sent as JSON: what each worker measured (rtts in milliseconds), the worker
+# with the lowest rtt, and the estimated location of the target, if any.
+def analysis_record(targets, results, est):
+    rows = []
+    for worker in targets:
+        row = {"worker": worker.location, "coords": worker.coords}
+        if worker.id not in results:
+            row["missing"] = True
+        elif results[worker.id][0] is None:
+            row["error"] = results[worker.id][1]
+        else:
+            low, median, p90 = (round(1000 * t, 1) for t in results[worker.id][0])
+            row.update(min_ms=low, median_ms=median, p90_ms=p90, ip=results[worker.id][1])
+        rows.append(row)
+    record = {"replied": len(results), "total": len(targets), "workers": rows}
+    best = best_worker(targets, results)
+    if best is not None:
+        record["best"] = {"worker": best.location, "coords": best.coords,
+                "ip": results[best.id][1], "min_ms": round(1000 * results[best.id][0][0], 1)}
+    if est is not None:
+        record["estimate"] = estimate_record(est)
+    return record
+
+# estimate_record() turns an estimated location (lat, lon, radius_km) into a
+# dict, ready to be sent as JSON, along with the nearest cloud region.
+def estimate_record(est):
+    (km, region) = regionindex.nearest(est[0], est[1])[0]
+    return {"lat": round(est[0], 2), "lon": round(est[1], 2), "radius_km": int(est[2]),
+            "region": region, "city": cloud.region_cities[region]}
+
+# ndjson_line() encodes one record as a line of newline-delimited JSON.
+def ndjson_line(record):
+    return (json.dumps(record, separators=(",", ":")) + "\n").encode()
+
+# analyze_batch() analyzes the hosts of all the given urls, and yields one line
+# of NDJSON for each host. Urls for the same host are only analyzed once, and
+# are all listed together on that host's line. Hosts that can be answered from
+# the result cache or the prefix index come first, right away. The rest are
+# analyzed in groups of batch_group_size hosts, each group in a single fan-out
+# by analyze_hosts(), so every worker gets one JOB frame for the whole group
+# rather than one per host. At most batch_concurrency groups are queued or
+# running on batch_pool at a time, and their lines come back in the order the
+# groups finish. Groups still share the result cache and any in-flight analysis
+# of the same host with everybody else. If the client goes away, the groups not
+# yet started are dropped when the generator is closed.
+def analyze_batch(urls):
+    hosts = {} # normalized host -> the urls given for it, in order
+    for url in urls:
+        try:
+            key = urlutil.normalize_host(url)
+            if len(url.encode()) > channel.MAX_URL:
+                raise ValueError("url too long")
+        except ValueError:
+            stats.batch_targets.inc(1, "malformed")
+            yield ndjson_line({"targets": [url], "error": "malformed target url"})
+            continue
+        stats.batch_targets.inc(1, "duplicate" if key in hosts else "unique")
+        hosts.setdefault(key, []).append(url)
+
+    unknown = [] # (host, urls) for the hosts that have to be analyzed
+    for (key, given) in hosts.items():
+        hit, analysis = lookup_host(key, given[0])
+        if hit is None and analysis is None:
+            unknown.append((key, given))
+        else:
+            yield batch_line(key, given, hit, analysis)
+
+    groups = (unknown[i:i+batch_group_size] for i in range(0, len(unknown), batch_group_size))
+    pending = {} # future -> the group of (host, urls) it is analyzing
+    try:
+        while True:
+            for group in itertools.islice(groups, batch_concurrency - len(pending)):
+                future = batch_pool.submit(analyze_hosts, [(key, given[0]) for (key, given) in group])
+                pending[future] = group
+            if len(pending) == 0:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                group = pending.pop(future)
+                if future.exception() is not None:
+                    for (key, given) in group:
+                        yield ndjson_line({"host": key, "targets": given, "error": str(future.exception())})
+                    continue
+                for ((key, given), analysis) in zip(group, future.result()):
+                    yield batch_line(key, given, None, analysis)
+    finally:
+        for future in pending:
+            future.cancel()
+
+# batch_line() returns the line of NDJSON for one host of a batch, given the
+# urls for it, and the pair (hit, analysis) that locate_host() would return.
+def batch_line(key, given, hit, analysis):
+    record = {"host": key, "targets": given}
+    if hit is None:
+        record.update(analysis_record(*analysis))
+    else:
+        ip, prefix, loc = hit
+        record["prefix"] = {"ip": ip, "prefix": prefix, "age_s": int(time.time() - loc.updated),
+                "measured_by": loc.workers}
+        record["estimate"] = estimate_record((loc.lat, loc.lon, loc.radius_km))
+    return ndjson_line(record)
+
+# Handle a batch of targets POSTed by a client, as a JSON list of urls (with
+# Content-Type application/json), or as plain text with one url per line. The
+# results are streamed back as NDJSON, one line per host, as they finish. An
+# HTTP/1.0 client can't take a chunked response, so it gets all the lines at
+# once instead.
+def http_post_analyze_batch(req, conn):
+    body = req.body or ""
+    if (req.headers.get("Content-Type") or "").startswith("application/json"):
+        try:
+            urls = json.loads(body)
+        except ValueError:
+            return Response("400 BAD REQUEST", "text/plain", "Malformed JSON")
+        if not isinstance(urls, list) or not all(isinstance(u, str) for u in urls):
+            return Response("400 BAD REQUEST", "text/plain", "Expected a JSON list of urls")
+    else:
+        urls = body.splitlines()
+    urls = [u.strip() for u in urls if u.strip()]
+    if len(urls) == 0:
+        return Response("400 BAD REQUEST", "text/plain", "No target urls given")
+    if len(urls) > batch_max_targets:
+        return Response("413 PAYLOAD TOO LARGE", "text/plain",
+                "At most %d target urls per batch" % (batch_max_targets))
+
+    log("Batch of %d targets from %s", len(urls), conn.client_addr)
+    if req.version != "HTTP/1.1":
+        return Response("200 OK", "application/x-ndjson", b"".join(analyze_batch(urls)))
+    resp = Response("200 OK", "application/x-ndjson")
+    resp.chunks = analyze_batch(urls)
+    return resp
 
-    
-    for i in range(len(workers)):
-        msg += "<h2> The RTT from %s %s is: %s seconds</h2>" % (location[i], coord[i], avg_rtt[i]) #location[0][0]
-    count = 0
-    #calc min average from rtt_list
-    for i in range(len(avg_rtt)):
-        if (avg_rtt[i] < min_rtt):
-            min_rtt = avg_rtt[i]
-            count = i
-    msg += "<h2> Based on the minimum RTT, your location is at %s with coordinates %s  and IP %s </h2>" %(location[count], coord[count], ips[count])
-    msg += "</body></html>"
-        
-    return Response("200 OK", "text/html", msg)
+# Show the stored measurements of one target ip, taken in the last max_age
+# seconds, as JSON, along with the location estimated from them. That way the
+# history can be used without probing the target again.
+def http_get_history(req, conn):
+    params = urllib.parse.parse_qs(req.query)
+    ip = params.get("ip", [""])[0]
+    if rtt_store is None:
+        return Response("404 NOT FOUND", "text/plain", "Measurements are not being kept")
+    if rttstore.pack_ip(ip) is None:
+        return Response("400 BAD REQUEST", "text/plain", "Malformed ip address: " + ip)
+    try:
+        max_age = float(params.get("max_age", [history_max_age])[0])
+    except ValueError:
+        return Response("400 BAD REQUEST", "text/plain", "Malformed max_age")
+
+    rows = []
+    lowest = {} # worker coordinates -> lowest rtt measured from there
+    for ((worker_id, loc, co), t, rtts) in rtt_store.lookup(ip, since=time.time() - max_age):
+        low, median, p90 = measure.summarize(rtts)
+        rows.append({"worker": loc, "coords": co, "time": round(t, 3), "samples": len(rtts),
+                "min_ms": round(1000 * low, 1), "median_ms": round(1000 * median, 1),
+                "p90_ms": round(1000 * p90, 1)})
+        lowest[co] = min(lowest.get(co, low), low)
+    record = {"ip": ip, "measurements": rows}
+    try:
+        if estimator is not None and len(lowest) > 0:
+            coords = [parse_coords(co) for co in lowest]
+            record["estimate"] = estimate_record(estimator.estimate(coords, list(lowest.values())))
+    except ValueError:
+        pass # some worker sent bad coordinates, no estimate then
+    return Response("200 OK", "application/json", json.dumps(record))
 
 #register worker called upon worker.py
-def http_register_worker(conn, body):
-    global workers
-    global location
-    global coord
-    global avg_rtt
-    global ips
-    print("trying to register client")
-    if sock not in workers:
-        workers.append(sock)
-        avg_rtt.append(None)
-        ips.append(None)
-    msg = ""
-
-    if "worker_info" in body:
-        res = body.split(':')
-        res = res[-1].split("'")
-        loc = res[1]
-        co = res[-1].split("]")
-        co = co[0].split("'")
-        co = str(co[0][2:])
-        if loc not in location:
-            location.append(loc)
-            coord.append(co)
-
-
-    return Response("acknowledged", "text/html", msg)
-    
+# The worker asks to upgrade its connection to the framed channel protocol. We
+# just remember who it is here; once the "101 SWITCHING PROTOCOLS" response has
+# been sent, the connection handler turns the connection into a channel and
+# calls serve_worker_channel().
+def http_register_worker(req, conn):
+    log("Worker is trying to register")
+    body = req.body
+    if body is None or "worker_info" not in body:
+        return Response("400 BAD REQUEST", "text/plain", "Missing worker_info")
+    if req.headers.get("Upgrade") != channel.PROTOCOL:
+        return Response("426 UPGRADE REQUIRED", "text/plain",
+                "Workers must upgrade to " + channel.PROTOCOL,
+                ["Upgrade: " + channel.PROTOCOL, "Connection: Upgrade"])
+
+    res = body.split(':')
+    res = res[-1].split("'")
+    loc = res[1]
+    co = res[-1].split("]")
+    co = co[0].split("'")
+    co = str(co[0][2:])
+    conn.worker_info = (loc, co)
+    conn.keepAlive = False # no more http requests, it's a channel from now on
+
+    return Response("101 SWITCHING PROTOCOLS", None, None,
+            ["Upgrade: " + channel.PROTOCOL, "Connection: Upgrade"])
+
+
+# serve_worker_channel() adds a newly registered worker to the registry, then
+# reads frames from its channel until the worker goes away. Each RESULT or ERROR
+# frame is handed to the analysis waiting on that job ID (if it has not already
+# given up), and the rtt samples are also appended to rtt_store. PONG frames
+# answer the heartbeats sent by heartbeat_loop(). A worker that is silent for
+# too long is disconnected, and once the worker goes away, it is removed from
+# the registry, and cached results it took part in are dropped.
+def serve_worker_channel(worker_channel, loc, co):
+    try:
+        latlon = parse_coords(co)
+    except ValueError:
+        log("Worker at %s sent bad coordinates %s, disconnecting it", loc, co)
+        worker_channel.close()
+        return
+    region = regionindex.nearest(latlon[0], latlon[1])[0][1]
+    worker = workers.add(worker_channel, loc, co, latlon, region, workerhealth.Health(loc))
+    health = worker.health
+    log("Worker %d at %s %s registered", worker.id, loc, co)
+
+    # A worker that crashed or lost its network can leave the connection open
+    # without ever sending anything again, so don't wait on it forever. This
+    # also keeps a send to a stuck worker from blocking for long.
+    worker_channel.sock.settimeout(workerhealth.dead_timeout)
+    try:
+        while True:
+            frame = worker_channel.recv_frame()
+            if frame is None:
+                break
+            kind, job_id, payload = frame
+            if kind == channel.PONG:
+                health.got_pong(job_id)
+                continue
+            health.got_frame()
+            if kind == channel.RESULT:
+                ip, rtt_times = channel.unpack_result(payload)
+                if len(rtt_times) == 0:
+                    summary, ip = None, "no rtt samples"
+                else:
+                    summary = measure.summarize(rtt_times)
+                    stats.probe_rtt.observe(summary[0], loc)
+                    if rtt_store is not None:
+                        rtt_store.append(worker.id, loc, co, ip, time.time(), rtt_times)
+            elif kind == channel.ERROR:
+                summary, ip = None, payload.decode()
+                stats.worker_errors.inc(1, loc)
+                log("Worker at %s failed job %d: %s", loc, job_id, ip)
+            else:
+                log("Ignoring unknown frame kind %d from worker at %s", kind, loc)
+                continue
+
+            health.job_answered(job_id)
+            with analyses_lock:
+                analysis = analyses.get(job_id)
+            if analysis is not None:
+                stats.job_time.observe(time.time() - analysis.started, loc)
+                analysis.add_result(worker.id, summary, ip)
+            else:
+                log("Late or unknown result for job %d from %s, discarding", job_id, loc)
+    except OSError as e:
+        log("Lost the channel to the worker at %s: %s", loc, e)
+    finally:
+        workers.remove(worker.id)
+        forget_worker_results(worker)
+        log("Worker %d at %s disconnected", worker.id, loc)
+        worker_channel.close()
+
+# forget_worker_results() drops every cached analysis that a worker which has
+# gone away took part in, so that the next request for those hosts is measured
+# again by the workers that are still there, instead of showing results from a
+# worker that no longer exists.
+def forget_worker_results(worker):
+    for (key, (targets, results, est)) in result_cache.items():
+        if worker in targets:
+            result_cache.discard(key)
+
+# send_ping() sends one heartbeat to a worker, noting any failure in its health.
+def send_ping(worker, seq):
+    try:
+        worker.health.sent_ping(seq)
+        worker.channel.send_ping(seq)
+    except OSError:
+        worker.health.send_failed()
+
+# heartbeat_loop() runs forever on a thread of its own, sending a heartbeat to
+# every worker each workerhealth.heartbeat_interval seconds, logging workers
+# that get evicted or re-admitted, and disconnecting workers that have gone
+# silent. Workers that never answered a job within workerhealth.job_timeout
+# seconds get a strike against their health here. The heartbeats are sent on
+# dispatch_pool, so a stuck worker never holds up the others. It also writes
+# out rtt measurements that have been buffered a while.
+def heartbeat_loop():
+    was_healthy = {} # worker ID -> health when last checked
+    for seq in itertools.count(1):
+        time.sleep(workerhealth.heartbeat_interval)
+        current = workers.snapshot()
+        for worker in current:
+            health = worker.health
+            if health.is_dead():
+                log("Worker at %s has been silent too long, disconnecting it", worker.location)
+                try:
+                    worker.channel.sock.shutdown(socket.SHUT_RDWR) # wakes up its reader
+                except OSError:
+                    pass
+                continue
+            health.check_jobs()
+            healthy = health.is_healthy()
+            if was_healthy.get(worker.id, True) != healthy:
+                if healthy:
+                    log("Worker at %s re-admitted", worker.location)
+                else:
+                    log("Worker at %s evicted: %s", worker.location, health.reason)
+                    stats.evictions.inc(1, worker.location)
+            was_healthy[worker.id] = healthy
+            dispatch_pool.submit(send_ping, worker, seq)
+        was_healthy = {w.id: was_healthy[w.id] for w in current if w.id in was_healthy}
+        if rtt_store is not None:
+            rtt_store.flush_stale()
+
+
+# not_modified() checks the conditional GET headers from the client, and returns
+# True if the client's cached copy, with the given ETag and modification time,
+# is still good.
+def not_modified(req, etag, mtime):
+    match = req.headers.get("If-None-Match")
+    if match is not None:
+        return match.strip() == "*" or etag in [m.strip() for m in match.split(",")]
+    since = req.headers.get("If-Modified-Since")
+    if since is not None:
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
 
 # handle_http_get_file() returns an appropriate response for a GET request that
 # seems to be for a file, rather than a special URL. If the file can't be found,
-# or if there are any problems, an error response is generated.
-def handle_http_get_file(url_path):
-    log("Handling http get file request, for "+ url_path)
-    file_path = server_root + url_path
-
-    # There is a very real security risk that the requested file_path could
-    # include things like "..", allowing a malicious or curious client to access
-    # files outside of the server's web_files directory. We take several
-    # precautions here to make sure that there is no funny business going on.
-    # First security precaution: "normalize" to eliminate ".." elements
-    file_path = os.path.normpath(file_path)
-    file_type = ''.join(url_path).split('.')[-1] 
-
-
-    # Third security precaution: check if the path is actually a file
-    if not os.path.isfile(file_path):
-        log("File was not found: " + file_path)
-        return Response("404 NOT FOUND", "text/plain", "No such file: " + url_path)
-
-    # Finally, attempt to read data from the file, and return it
+# or if there are any problems, an error response is generated. Files come from
+# static_files, so popular ones are served straight from memory, compressed if
+# the client accepts it. Files too big to keep in memory are streamed from disk
+# by sendfile(). If the client already has an up-to-date copy of the file
+# (according to its ETag or Last-Modified date), a 304 is returned instead.
+def handle_http_get_file(url_path, req):
+    logutil.debug("Handling http get file request, for %s", url_path)
     try:
-        with open(file_path, "rb") as f: # "rb" mode means read "raw bytes"
-            data = f.read()
-
-        if file_type == "png":
-            mime_type = "image/png"
-        elif file_type == "jpg" or file_type == "jpeg":
-            mime_type = "image/jpeg"
-        elif file_type == "html":
-            mime_type = "text/html"
-        elif file_type == "css":
-            mime_type = "text/css"
-        elif file_type == "js":
-            mime_type = "application/javascript"
-        elif file_type == "txt":
-            mime_type = "text/plain"
-        return Response("200 OK", mime_type, data)
-    except:
-        log("Error encountered reading from file")
+        entry = static_files.get(url_path)
+    except OSError:
+        log("Error encountered reading file")
         return Response("403 FORBIDDEN", "text/plain", "Permission denied: " + url_path)
+    if entry is None:
+        log("File was not found: %s", url_path)
+        return Response("404 NOT FOUND", "text/plain", "No such file: " + url_path)
 
+    encoding, etag, body = entry.select(req.headers.get("Accept-Encoding"))
+    headers = ["ETag: " + etag, "Last-Modified: " + entry.last_modified]
+    if entry.variants:
+        headers.append("Vary: Accept-Encoding")
+    if not_modified(req, etag, entry.mtime):
+        return Response("304 NOT MODIFIED", None, None, headers)
+    if encoding is not None:
+        headers.append("Content-Encoding: " + encoding)
+    if body is not None:
+        return Response("200 OK", entry.mime_type, body, headers)
 
-# handle_http_get() returns an appropriate response for a GET request
-def handle_http_get(req,conn):
-    global avg_rtt
-    global location
-    global workers
-    global coord
-
-    rtt_times = [0]
-
-    username = req.path.split('=') #prev project, not needed
-    req.start = username[0].split('?')[0] #finds path before variables
-    # Generate a response
-    if req.start == "/hello":
-        color = ["#"+''.join([random.choice('0123456789ABCDEF') for j in range(6)]) for i in range(1)] #random hex color
-        resp = handle_http_get_hello(color[0],username[-1])
-    elif req.start == "/analyze":
-        resp = http_get_analyze(req.path,conn,req)
-    elif req.path == "/register_worker":
-        resp = http_register_worker(conn, req.body)
-    elif req.path == "/rtt-time":
-
-        first = req.body.split('\r\n')
-        loc = first[0]
-
-        if "worker_info" in loc:
-            res = loc.split(':')
-            res = res[-1].split("'")
-            loc = res[1]
-
-        #if in location, add ip + calculate avg rtt
-            if loc in location:
-                index = location.index(loc)
-                rtt_times = first[1].split(':')[-1].strip('][').split(', ')
-                rtt_times[0] = rtt_times[0][2:]
-
-                ip = first[-2]
-                ip = ip.split(":")
-                
-                ips[index] = ip[-1]
-            #calc average rtt
-
-            average = 0
-            if(len(rtt_times) > 0):
-                for i in range(len(rtt_times)):
-                    temp_rtt = float(rtt_times[i])
-                    average += temp_rtt
-
-                if len(avg_rtt) <= len(workers):
-                    if len(workers) - len(avg_rtt) == 1 or len(avg_rtt) == 0:
-                        avg_rtt.append(average/len(rtt_times))
+    # Too big to keep in memory, so attempt to open the file, and return it
+    try:
+        f = open(entry.path, "rb") # "rb" mode means read "raw bytes"
+        size = os.fstat(f.fileno()).st_size
+    except OSError:
+        log("Error encountered opening file")
+        return Response("403 FORBIDDEN", "text/plain", "Permission denied: " + url_path)
+    resp = Response("200 OK", entry.mime_type, None, headers)
+    resp.file = f
+    resp.file_size = size
+    return resp
 
-                    avg_rtt[index] = average/len(rtt_times)
-            
 
-        resp = location_page()
-    elif req.start == "/" or req.start == "/index":
-        resp = http_get_index()
+# add_route() registers handler for requests with the given method and path. The
+# handler is called as handler(req, conn) and should return a Response. If
+# prefix is True, the handler also gets any path that starts with the given
+# path, unless a more specific route matches.
+def add_route(method, path, handler, prefix=False):
+    if prefix:
+        table = prefix_routes.setdefault(method, [])
+        table.append((path, handler))
+        table.sort(key=lambda route: len(route[0]), reverse=True) # longest first
     else:
-        resp = handle_http_get_file(req.path)
-    return resp
+        routes.setdefault(method, {})[path] = handler
+
+# find_route() returns a pair (route, handler) with the name of the route and
+# the handler registered for a method and path, or (None, None). The name of an
+# exact route is its path, and the name of a prefix route is its prefix + "*".
+def find_route(method, path):
+    handler = routes.get(method, {}).get(path)
+    if handler is None:
+        for (prefix, h) in prefix_routes.get(method, ()):
+            if path.startswith(prefix):
+                return prefix + "*", h
+        return None, None
+    return path, handler
+
+# handle_http_get() returns an appropriate response for a GET request for a file,
+# i.e. one that doesn't match any registered route.
+def handle_http_get(req, conn):
+    return handle_http_get_file(req.path, req)
 
 
 # handle_http_connection() reads one or more HTTP requests from a client, parses
@@ -517,72 +1325,276 @@ def handle_http_get(req,conn):
 def handle_http_connection(conn):
     conn.keepAlive = True
     
-    with stats.lock: # update overall server statistics
-        stats.active_connections += 1
-    log("Handling connection from " + str(conn.client_addr)) 
+    stats.active_connections.inc()
+    logutil.sampled("Handling connection from %s", conn.client_addr)
     
     try:
         # Process one HTTP request from client
         while conn.keepAlive is True:
-            start = time.time()
             conn.keepAlive = False
-            handle_one_http_request(conn)
+            route = handle_one_http_request(conn)
             end = time.time()
-            duration = end - start
+            duration = end - conn.started
+            if route is None:
+                break
             
             # Do end-of-request statistics and cleanup
             conn.num_requests += 1 # counter for this connection
-            log("Done handling request %d from %s" % (conn.num_requests, conn.client_addr))
-            with stats.lock: # update overall server statistics
-                stats.num_requests += 1
-                stats.tot_time = stats.tot_time + duration
-                stats.avg_time = stats.tot_time / stats.num_requests
-                if duration > stats.max_time:
-                    stats.max_time = duration
+            logutil.debug("Done handling request %d from %s", conn.num_requests, conn.client_addr)
+            record_request_stats(route, duration)
+
+        # A worker that registered has switched this connection over to the
+        # framed channel protocol, so keep serving it as a channel.
+        if conn.worker_info is not None:
+            conn.sock.unrecv(conn.parser.pending())
+            serve_worker_channel(channel.Channel(conn.sock), *conn.worker_info)
                 
     finally:
         
         conn.sock.close() #keepalive keeps this open
-        log("Done with connection from " + str(conn.client_addr))
-        with stats.lock: # update overall server statistics
-            stats.active_connections -= 1
+        logutil.sampled("Done with connection from %s", conn.client_addr)
+        stats.active_connections.dec()
     
 
+# AsyncConnection objects are the asyncio-mode equivalent of Connection
+# objects. Instead of a blocking socket, they hold the asyncio stream reader and
+# writer for the client.
+class AsyncConnection:
+    def __init__(self, reader, writer):
+        self.reader = reader       # asyncio stream to read from the client
+        self.writer = writer       # asyncio stream to write to the client
+        self.client_addr = writer.get_extra_info("peername")
+        self.num_requests = 0      # number of requests from client handled so far
+        self.worker_info = None    # (location, coords) if a worker registered here
+        self.route = None          # route taken by the current request
+        self.parser = httpparse.RequestParser() # parses data from the client
+        self.keepAlive = True
+
+    # fill() is like Connection.fill(), but must be awaited.
+    async def fill(self):
+        try:
+            data = await self.reader.read(65536)
+        except ConnectionError:
+            log("Error reading from client %s socket", str(self.client_addr))
+            return False
+        self.parser.feed(data)
+        return len(data) > 0
+
+    # read_request_head() is like Connection.read_request_head(), but must be
+    # awaited.
+    async def read_request_head(self):
+        while True:
+            head = self.parser.parse_head()
+            if head is not None:
+                return head
+            if not await self.fill():
+                return None
+
+    # read_body() is like Connection.read_body(), but must be awaited.
+    async def read_body(self):
+        parts = []
+        while True:
+            parts.append(self.parser.read_body())
+            if self.parser.body_done:
+                return b"".join(parts).decode(errors="replace")
+            if not await self.fill():
+                return None
+
+
+# detach_worker_channel() takes the socket for a worker that registered on an
+# asyncio connection away from the event loop, and serves it as a channel on a
+# thread of its own, just like in threaded mode. The worker waits for the
+# "101 SWITCHING PROTOCOLS" response before sending any frames, so the only data
+# that could be left over is whatever the parser is holding, which is carried
+# over to the new socket.
+def detach_worker_channel(conn):
+    transport = conn.writer.transport
+    transport.pause_reading()
+    tsock = transport.get_extra_info("socket")
+    sock = socketutil.socket(tsock.family, tsock.type, tsock.proto, os.dup(tsock.fileno()))
+    sock.setblocking(True)
+    sock.unrecv(conn.parser.pending())
+    transport.abort() # closes the event loop's copy of the socket only
+    t = threading.Thread(target=serve_worker_channel,
+            args=(channel.Channel(sock),) + conn.worker_info)
+    t.daemon = True
+    t.start()
+
+
+# handle_async_connection() is the asyncio-mode equivalent of
+# handle_http_connection(). It runs on the event loop, so an idle keep-alive
+# connection costs only a suspended coroutine rather than a whole thread. The
+# request handlers themselves can block (e.g. /analyze waits for the workers),
+# so they are run on handler_pool instead of on the event loop.
+async def handle_async_connection(reader, writer):
+    loop = asyncio.get_running_loop()
+    conn = AsyncConnection(reader, writer)
+    stats.total_connections.inc()
+    stats.active_connections.inc()
+    logutil.sampled("Handling connection from %s", conn.client_addr)
+
+    try:
+        while conn.keepAlive is True:
+            conn.keepAlive = False
+            conn.route = "invalid"
+            start = time.time()
+            try:
+                head = await conn.read_request_head()
+                if head is None:
+                    break
+                start = time.time() # don't count time spent idle, waiting for the request
+                req = parse_http_request(conn, head)
+                if not conn.parser.body_done:
+                    req.body = await conn.read_body()
+                    if req.body is None:
+                        break
+                resp = await loop.run_in_executor(handler_pool, handle_http_request, req, conn)
+            except httpparse.HTTPError as e:
+                resp = http_error_response(conn, e)
+            head, body = format_http_response(conn, resp)
+            if body is not None:
+                writer.writelines([head, body])
+            else:
+                writer.write(head)
+            await writer.drain()
+            if resp.file is not None:
+                try:
+                    await loop.sendfile(writer.transport, resp.file, 0, resp.file_size)
+                finally:
+                    resp.file.close()
+            if resp.chunks is not None:
+                # Producing a chunk can block, so that's done on handler_pool.
+                try:
+                    while True:
+                        chunk = await loop.run_in_executor(handler_pool, next, resp.chunks, None)
+                        if chunk is None:
+                            break
+                        if len(chunk) > 0:
+                            writer.writelines(frame_chunk(chunk))
+                            await writer.drain()
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+                finally:
+                    resp.chunks.close()
+            duration = time.time() - start
+
+            conn.num_requests += 1 # counter for this connection
+            logutil.debug("Done handling request %d from %s", conn.num_requests, conn.client_addr)
+            record_request_stats(conn.route, duration)
+
+        if conn.worker_info is not None:
+            detach_worker_channel(conn)
+    except ConnectionError:
+        log("Connection from %s was lost", str(conn.client_addr))
+    finally:
+        writer.close()
+        logutil.sampled("Done with connection from %s", conn.client_addr)
+        stats.active_connections.dec()
+
+
+# run_async_server() runs the asyncio-mode server until it is interrupted.
+async def run_async_server():
+    server = await asyncio.start_server(handle_async_connection,
+            server_host or None, server_port, backlog=server_backlog,
+            reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+# run_threaded_server() runs the thread-per-connection server until it is
+# interrupted.
+def run_threaded_server():
+    # Create the server socket, and set it up to listen for connections
+    s = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind(server_addr)
+    s.listen(server_backlog)
+
+    try:
+        # Repeatedly accept and handle connections
+        while True:
+            sock, client_addr = s.accept()
+            
+            
+            # A new client socket connection has been accepted. Count it.
+            stats.total_connections.inc()
+            # Put the info into a Connection object.
+            conn = Connection(sock, client_addr)
+            # Start a thread to handle the new connection.
+            t = threading.Thread(target=handle_http_connection, args=(conn,))
+            t.daemon = True
+            t.start()
+    finally:
+        log("Shutting down...")
+        s.close()
+
+
+# Routing tables, mapping each method to {path: handler} for exact matches and
+# to a list of (prefix, handler) pairs, longest prefix first, for prefix matches.
+routes = {}
+prefix_routes = {}
+
+add_route("GET", "/", http_get_index)
+add_route("GET", "/index", http_get_index)
+add_route("GET", "/hello", handle_http_get_hello)
+add_route("GET", "/analyze", http_get_analyze)
+add_route("POST", "/analyze_batch", http_post_analyze_batch)
+add_route("GET", "/register_worker", http_register_worker)
+add_route("GET", "/metrics", http_get_metrics)
+add_route("GET", "/history", http_get_history)
+
+
 # This remainder of this file is the main program, which listens on a server
-# socket for incoming connections from clients, and starts a handler thread for
-# each one.
+# socket for incoming connections from clients, and handles each one with
+# either a thread or an asyncio coroutine, depending on the server mode.
+
+# Command-line options can override the server mode, listen backlog, logging,
+# and where measurements are kept, e.g.
+#   python3 central.py --mode asyncio --backlog 1024 --log-level warning
+parser = argparse.ArgumentParser()
+parser.add_argument("--mode", choices=["threads", "asyncio"], default=server_mode)
+parser.add_argument("--backlog", type=int, default=server_backlog)
+parser.add_argument("--select", choices=["all", "adaptive"], default=select_mode,
+        help="probe with all workers, or a few spread out ones and then the nearest")
+parser.add_argument("--log-level", choices=list(logutil.LEVEL_NAMES), default="info")
+parser.add_argument("--log-sample", type=int, default=logutil.sample_rate,
+        help="only log one in every N per-connection messages")
+parser.add_argument("--prefix-max-age", type=float, default=prefix_max_age,
+        help="seconds a location found for an ip prefix is reused, 0 to always probe")
+parser.add_argument("--store", default=rtt_store_dir,
+        help="directory to keep rtt measurements in, or \"\" to not keep them")
+options, _ = parser.parse_known_args()
+server_mode = options.mode
+server_backlog = options.backlog
+select_mode = options.select
+rtt_store_dir = options.store
+prefix_max_age = options.prefix_max_age
+target_ips.ttl = prefix_max_age
+logutil.level = logutil.LEVEL_NAMES[options.log_level]
+logutil.sample_rate = max(1, options.log_sample)
 
 # Print a welcome message
 server_addr = (server_host, server_port)
-log("Starting web server")
-log("Listening on address %s:%d" % (server_host, server_port))
-log("Serving files from %s" % (server_root))
+log("Starting web server in %s mode", server_mode)
+log("Listening on address %s:%d (backlog %d)", server_host, server_port, server_backlog)
+log("Serving files from %s", server_root)
+if rtt_store_dir:
+    rtt_store = rttstore.Store(rtt_store_dir)
+    atexit.register(rtt_store.close)
+    log("Keeping rtt measurements in %s", rtt_store_dir)
 log("Ready for connections...")
 
-# Create the server socket, and set it up to listen for connections
-s = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
-s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-s.bind(server_addr)
-s.listen(5)
+# Start sending heartbeats to the workers.
+t = threading.Thread(target=heartbeat_loop, name="heartbeat")
+t.daemon = True
+t.start()
 
-try:
-    # Repeatedly accept and handle connections
-    while True:
-        sock, client_addr = s.accept()
-        print("got connection from client %s:%s" % (client_addr))
-        
-        
-        # A new client socket connection has been accepted. Count it.
-        with stats.lock:
-            stats.total_connections += 1
-        # Put the info into a Connection object.
-        conn = Connection(sock, client_addr)
-        # Start a thread to handle the new connection.
-        t = threading.Thread(target=handle_http_connection, args=(conn,))
-        t.daemon = True
-        t.start()
-finally:
-    log("Shutting down...")
-    s.close()
-
-log("Done")
\ No newline at end of file
+if server_mode == "asyncio":
+    try:
+        asyncio.run(run_async_server())
+    except KeyboardInterrupt:
+        log("Shutting down...")
+else:
+    run_threaded_server()
+
+log("Done")
@@ -0,0 +1,158 @@
+# channel.py module
+
+"""
+This module implements the framed binary protocol spoken between central and
+its workers. A worker opens one persistent connection to central, registers
+with an HTTP request that asks to upgrade the connection, and from then on both
+sides exchange frames over that same socket in both directions.
+
+Every frame has a fixed 9 byte header followed by a variable-length payload:
+
+    +----------------+--------+----------------+-------------------+
+    | payload length |  kind  |     job id     |  payload ...      |
+    |   4 bytes      | 1 byte |    4 bytes     |  length bytes     |
+    +----------------+--------+----------------+-------------------+
+
+All integers are unsigned and in network byte order. Job ids are chosen by
+central, and the worker copies them into the RESULT or ERROR frames it sends
+back, so many jobs can be in flight on one channel at once and results can
+come back in any order. One JOB frame can carry several urls, each with a job
+id of its own (the one in the frame header is that of the first url), so a
+batch of targets costs one frame per worker rather than one per target. The
+worker answers each url with a separate RESULT or ERROR frame, as soon as that
+url is done. PING and PONG frames have no payload, and use the job id field for
+a heartbeat sequence number instead.
+
+Example usage:
+
+    import channel
+
+    ch = channel.Channel(sock)            # sock is a connected socketutil.socket
+    ch.send_job(17, "http://www.google.com/", "connect", 5)
+    ch.send_jobs([(18, "http://example.com/"), (19, "http://example.org/")], "connect", 5)
+    kind, job_id, payload = ch.recv_frame()
+    if kind == channel.RESULT:
+        ip, rtts = channel.unpack_result(payload)
+"""
+
+import struct
+import threading
+
+# Name of the protocol, as used in the HTTP "Upgrade" header.
+PROTOCOL = "geolocate-channel/4"
+
+# Frame kinds
+JOB = 1     # central -> worker, payload is the measurement mode and target urls
+RESULT = 2  # worker -> central, payload is the target ip and rtt samples
+ERROR = 3   # worker -> central, payload is an error message
+PING = 4    # central -> worker, heartbeat, the job id is a sequence number
+PONG = 5    # worker -> central, answer to a PING, with the same sequence number
+
+HEADER = struct.Struct("!IBI")
+
+# Largest payload we are willing to accept, anything bigger means the other
+# side is confused (or not speaking this protocol at all).
+MAX_PAYLOAD = 1 << 20
+
+# Longest url a JOB frame can carry, in bytes.
+MAX_URL = 0xffff
+
+"""Pack the payload of a JOB frame: the measurement mode (see measure.py), the
+number of samples to take, and the target urls, given as a list of pairs
+(job id, url)."""
+def pack_job(jobs, mode, samples):
+    mode = mode.encode()
+    parts = [struct.pack("!B", len(mode)), mode, struct.pack("!HH", samples, len(jobs))]
+    for (job_id, url) in jobs:
+        url = url.encode()
+        parts.append(struct.pack("!IH", job_id, len(url)))
+        parts.append(url)
+    return b"".join(parts)
+
+"""Unpack the payload of a JOB frame, returning a tuple (jobs, mode, samples),
+where jobs is a list of pairs (job id, url)."""
+def unpack_job(payload):
+    n = payload[0]
+    mode = payload[1:1+n].decode()
+    samples, count = struct.unpack_from("!HH", payload, 1+n)
+    pos = 5 + n
+    jobs = []
+    for i in range(count):
+        job_id, length = struct.unpack_from("!IH", payload, pos)
+        jobs.append((job_id, payload[pos+6:pos+6+length].decode()))
+        pos += 6 + length
+    return jobs, mode, samples
+
+"""Pack the payload of a RESULT frame: the target's ip address and a list of
+rtt samples, in seconds."""
+def pack_result(ip, rtts):
+    ip = ip.encode()
+    return (struct.pack("!H", len(ip)) + ip +
+            struct.pack("!H%dd" % len(rtts), len(rtts), *rtts))
+
+"""Unpack the payload of a RESULT frame, returning a pair (ip, rtts)."""
+def unpack_result(payload):
+    (n,) = struct.unpack_from("!H", payload, 0)
+    ip = payload[2:2+n].decode()
+    (count,) = struct.unpack_from("!H", payload, 2+n)
+    rtts = list(struct.unpack_from("!%dd" % count, payload, 4+n))
+    return ip, rtts
+
+"""Channel wraps a connected socketutil.socket and sends and receives frames
+on it. Sending is thread-safe, so many threads can send frames on the same
+channel at once. Receiving should be done by a single reader thread."""
+class Channel:
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.send_lock = threading.Lock()
+
+    """Send one frame. The payload can be a string or bytes."""
+    def send_frame(self, kind, job_id, payload=b""):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        frame = HEADER.pack(len(payload), kind, job_id) + payload
+        with self.send_lock:
+            self.sock.sendall(frame)
+
+    """Receive one frame, returning a tuple (kind, job_id, payload), or None if
+    the connection was closed or the other side sent garbage."""
+    def recv_frame(self):
+        header = self.sock.recv_exactly(HEADER.size)
+        if header is None:
+            return None
+        length, kind, job_id = HEADER.unpack(header)
+        if length > MAX_PAYLOAD:
+            return None
+        payload = self.sock.recv_exactly(length) if length > 0 else b""
+        if payload is None:
+            return None
+        return kind, job_id, payload
+
+    """Send a JOB frame asking the worker to measure the rtt to a url."""
+    def send_job(self, job_id, url, mode, samples):
+        self.send_jobs([(job_id, url)], mode, samples)
+
+    """Send a JOB frame asking the worker to measure the rtt to several urls,
+    given as a list of pairs (job id, url)."""
+    def send_jobs(self, jobs, mode, samples):
+        self.send_frame(JOB, jobs[0][0], pack_job(jobs, mode, samples))
+
+    """Send a RESULT frame with the answer to a job."""
+    def send_result(self, job_id, ip, rtts):
+        self.send_frame(RESULT, job_id, pack_result(ip, rtts))
+
+    """Send an ERROR frame saying a job could not be done."""
+    def send_error(self, job_id, msg):
+        self.send_frame(ERROR, job_id, msg)
+
+    """Send a PING frame, asking the other side to answer with a PONG."""
+    def send_ping(self, seq):
+        self.send_frame(PING, seq)
+
+    """Send a PONG frame answering a PING."""
+    def send_pong(self, seq):
+        self.send_frame(PONG, seq)
+
+    def close(self):
+        self.sock.close()
@@ -17,6 +17,14 @@ where you are running this code. For example:
      cloud.city: "Palo Alto"
    cloud.coords: (37.44, -122.14)   # this is a pair containing latitude, longitude
 
+The information about the current machine is only looked up the first time one
+of these variables is used, by asking the AWS and GCP meta-data services at the
+same time, with short timeouts. A successful answer is saved in cache_file, so
+the next time this code starts up on the same machine it doesn't need to ask
+again. Failing to find out is never saved, so a cloud machine whose meta-data
+service was slow once asks again next time, rather than using the defaults for
+a day.
+
 You can also run this file in standalone demo mode like this:
   python3 cloud.py
 It will print out information about every known EC2 and GCE datacenter, along
@@ -49,6 +57,21 @@ with info about the cloud machine where you are running this code, if known.
 # Compute (EC2) and Google Compute Engine (GCE).
 
 
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+
+# Seconds to wait for each meta-data request before deciding we are not running
+# on that cloud.
+metadata_timeout = 1.0
+
+# Where the information about the current machine is saved, and for how many
+# seconds it is trusted.
+cache_file = os.path.expanduser("~/.geolocate_cloud.json")
+cache_max_age = 24 * 3600
+
 # list of all region names
 aws_regions = [ # AWS regions
     "us-east-1", "us-east-2", "us-west-1", "us-west-2",
@@ -226,21 +249,21 @@ region_coords = {
 # Amazon mechanism for getting our own external IP address
 def aws_get_my_external_ip():
     import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/public-ipv4')
+    r = requests.get('http://169.254.169.254/latest/meta-data/public-ipv4', timeout = metadata_timeout)
     r.raise_for_status()
     return r.text
 
 # Amazon mechanism for getting our own external DNS hostname
 def aws_get_my_dns_hostname():
     import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/public-hostname')
+    r = requests.get('http://169.254.169.254/latest/meta-data/public-hostname', timeout = metadata_timeout)
     r.raise_for_status()
     return r.text
 
 # Amazon mechanism for getting our own availability zone
 def aws_get_my_zone():
     import requests
-    r = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone/')
+    r = requests.get('http://169.254.169.254/latest/meta-data/placement/availability-zone/', timeout = metadata_timeout)
     r.raise_for_status()
     return r.text
 
@@ -257,7 +280,7 @@ def aws_region_for_zone(z):
 def gcp_get_my_internal_hostname():
     import requests
     metadata_flavor = {'Metadata-Flavor' : 'Google'}
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/name', headers = metadata_flavor)
+    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/name', headers = metadata_flavor, timeout = metadata_timeout)
     r.raise_for_status()
     return r.text
 
@@ -265,7 +288,7 @@ def gcp_get_my_internal_hostname():
 def gcp_get_my_external_ip():
     import requests
     metadata_flavor = {'Metadata-Flavor' : 'Google'}
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/network-interfaces/0/access-configs/0/external-ip', headers = metadata_flavor)
+    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/network-interfaces/0/access-configs/0/external-ip', headers = metadata_flavor, timeout = metadata_timeout)
     r.raise_for_status()
     return r.text
 
@@ -273,7 +296,7 @@ def gcp_get_my_external_ip():
 def gcp_get_my_zone():
     import requests
     metadata_flavor = {'Metadata-Flavor' : 'Google'}
-    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/zone', headers = metadata_flavor)
+    r = requests.get('http://metadata.google.internal/computeMetadata/v1/instance/zone', headers = metadata_flavor, timeout = metadata_timeout)
     r.raise_for_status()
     return r.text.split('/')[-1]
 
@@ -287,46 +310,121 @@ def gcp_region_for_zone(z):
     else:
         return z
 
-# Default values, in case we are not running in the cloud.
-dnsname = "localhost"
-ipaddr = "127.0.0.1"
-provider = None
-zone = None
-region = None
-title = None
-city = None
-coords = (0, 0)
-
-# Try to figure out information about our own host.
-try:
-    # First try AWS meta-data service to figure out our own ec2 availability zone and region.
+# Amazon mechanism for finding out everything about our own host, returned as a
+# dict. This raises an exception if we are not running on AWS.
+def aws_discover():
     print("Checking for AWS meta-data...")
-    dnsname = aws_get_my_dns_hostname()
-    ipaddr = aws_get_my_external_ip()
     zone = aws_get_my_zone()
-    region = aws_region_for_zone(zone)
-    title = region_titles[region]
-    city = region_cities[region]
-    coords = region_coords[region]
-    provider = "Amazon AWS/EC2 Cloud"
-except:
+    return { "dnsname": aws_get_my_dns_hostname(),
+             "ipaddr": aws_get_my_external_ip(),
+             "provider": "Amazon AWS/EC2 Cloud",
+             "zone": zone,
+             "region": aws_region_for_zone(zone) }
+
+# Google mechanism for finding out everything about our own host, returned as a
+# dict. This raises an exception if we are not running on GCP.
+def gcp_discover():
+    print("Checking for GCP meta-data...")
+    zone = gcp_get_my_zone()
+    return { "dnsname": gcp_get_my_internal_hostname(),
+             "ipaddr": gcp_get_my_external_ip(),
+             "provider": "Google GCP/GCE Cloud",
+             "zone": zone,
+             "region": gcp_region_for_zone(zone) }
+
+# Default values, in case we are not running in the cloud.
+defaults = {
+    "dnsname": "localhost",
+    "ipaddr": "127.0.0.1",
+    "provider": None,
+    "zone": None,
+    "region": None,
+}
+
+# Names of the variables that are filled in by discover().
+host_info_names = ("dnsname", "ipaddr", "provider", "zone", "region", "title", "city", "coords")
+
+discovered = False
+discover_lock = threading.Lock()
+
+# load_cache() returns the host info saved in cache_file, or None if there is no
+# such file, it is too old, or it doesn't name a known region (as written by
+# older versions of this code when discovery failed).
+def load_cache():
     try:
-        # If that fails, next try GCP meta-data service.
-        print("Checking for GCP meta-data...")
-        dnsname = gcp_get_my_internal_hostname()
-        ipaddr = gcp_get_my_external_ip()
-        zone = gcp_get_my_zone()
-        region = gcp_region_for_zone(zone)
-        title = region_titles[region]
-        city = region_cities[region]
-        coords = region_coords[region]
-        provider = "Google GCP/GCE Cloud"
-    except:
-        # If that fails, give up and just accept the default values.
+        with open(cache_file) as f:
+            saved = json.load(f)
+        if time.time() - saved["saved_at"] > cache_max_age:
+            return None
+        if saved["info"]["region"] not in region_titles:
+            return None
+        return saved["info"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+# save_cache() saves host info to cache_file, ignoring any errors.
+def save_cache(info):
+    try:
+        with open(cache_file, "w") as f:
+            json.dump({ "saved_at": time.time(), "info": info }, f)
+    except OSError:
         pass
 
+# probe_metadata() asks the AWS and GCP meta-data services at the same time,
+# and returns the host info from whichever answers, or None if neither does.
+# Each service gets three requests' worth of metadata_timeout (plus a second
+# for resolving its name, which the request timeouts don't cover), and we don't
+# wait for the other service once one has answered.
+def probe_metadata():
+    pool = ThreadPoolExecutor(max_workers=2)
+    try:
+        futures = [pool.submit(aws_discover), pool.submit(gcp_discover)]
+        for f in as_completed(futures, timeout=3 * metadata_timeout + 1):
+            try:
+                info = f.result()
+                if info["region"] in region_titles:
+                    return info
+            except:
+                pass
+    except TimeoutError:
+        pass
+    finally:
+        pool.shutdown(wait=False)
+    return None
+
+# discover() figures out information about our own host, from cache_file if
+# possible, or else from the meta-data services, and sets the module variables
+# listed in host_info_names. It only does the work once, and is called
+# automatically the first time any of those variables is used.
+def discover():
+    global discovered
+    with discover_lock:
+        if discovered:
+            return
+        info = load_cache()
+        if info is None:
+            info = probe_metadata()
+            if info is not None:
+                save_cache(info)
+            else:
+                info = dict(defaults)
+        region = info["region"]
+        info["title"] = region_titles.get(region)
+        info["city"] = region_cities.get(region)
+        info["coords"] = region_coords.get(region, (0, 0))
+        globals().update(info)
+        discovered = True
+
+# Looking up cloud.city (or any other host info variable) triggers discover().
+def __getattr__(name):
+    if name in host_info_names:
+        discover()
+        return globals()[name]
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
 # test code
 if __name__ == "__main__":
+    discover()
 
     print("There are %d Amazon Web Services regions." % (len(aws_regions)))
     print("%-16s %-26s %-36s %s, %s" % ("zone", "title", "city", "lat", "lon"))
@@ -0,0 +1,143 @@
+# connpool.py module
+
+"""
+This module contains a pool of idle keep-alive connections to web servers,
+for the workers. Opening a new connection for every probe costs a TCP
+handshake each time, so when a measurement mode allows it, the connection is
+put back in the pool once the probe is done with it, and the next probe of the
+same (ip, port) takes it out again instead of connecting.
+
+Only connections that are idle live in the pool; a connection that is in use
+belongs to whoever took it out. The pool keeps at most max_idle_per_host idle
+connections to any one (ip, port), and at most max_idle in total, closing the
+longest-idle ones beyond that. Connections that have been idle for more than
+idle_timeout seconds are closed by a background thread, and a connection the
+server has closed (or that has unexpected data waiting on it) is noticed and
+closed when it is taken out, so probes don't get handed a dead connection.
+
+Example usage:
+
+    import connpool
+
+    pool = connpool.Pool()
+    s = pool.get(ip, 80)          # an idle connection, or None
+    if s is None:
+        s = ...                   # open a new one
+    ...                           # use it
+    pool.put(ip, 80, s)           # or s.close(), if it can't be reused
+    pool.close()                  # close all the idle connections
+"""
+
+import collections
+import socket
+import threading
+import time
+
+max_idle = 64          # max idle connections kept, in total
+max_idle_per_host = 4  # max idle connections kept to any one (ip, port)
+idle_timeout = 30.0    # seconds a connection can stay idle before it's closed
+
+"""Return True if the idle connection s still looks usable: the server
+hasn't closed it, and nothing unexpected has arrived on it."""
+def is_usable(s):
+    if s.buffered() > 0:
+        return False
+    timeout = s.gettimeout()
+    s.setblocking(False) # otherwise recv() would wait for the timeout
+    try:
+        socket.socket.recv(s, 1, socket.MSG_PEEK)
+    except (BlockingIOError, InterruptedError):
+        return True # nothing to read, as it should be
+    except OSError:
+        return False
+    finally:
+        s.settimeout(timeout)
+    return False # either closed (b"") or unexpected data
+
+"""Pool holds the idle connections, keyed by (ip, port). All methods are
+thread-safe."""
+class Pool:
+
+    def __init__(self):
+        self.idle = {}        # (ip, port) -> list of idle sockets, most recent last
+        self.order = collections.OrderedDict() # socket -> ((ip, port), when idle), oldest first
+        self.lock = threading.Lock()
+        self.reaper = None
+        self.closed = False
+
+    """Take an idle connection to (ip, port) out of the pool, returning it, or
+    None if there isn't a usable one."""
+    def get(self, ip, port):
+        key = (ip, port)
+        while True:
+            with self.lock:
+                conns = self.idle.get(key)
+                if not conns:
+                    return None
+                s = conns.pop()
+                if not conns:
+                    del self.idle[key]
+                del self.order[s]
+            if is_usable(s):
+                return s
+            s.close()
+
+    """Give a connection to (ip, port) back to the pool, once it is idle, or
+    close it if the pool is full or closed."""
+    def put(self, ip, port, s):
+        key = (ip, port)
+        evicted = []
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if self.closed or len(conns) >= max_idle_per_host:
+                evicted.append(s)
+            else:
+                conns.append(s)
+                self.order[s] = (key, time.monotonic())
+                while len(self.order) > max_idle:
+                    evicted.append(self.remove_oldest())
+            if not conns:
+                self.idle.pop(key, None)
+            if self.reaper is None and not self.closed:
+                self.reaper = threading.Thread(target=self.reap, name="connpool", daemon=True)
+                self.reaper.start()
+        for old in evicted:
+            old.close()
+
+    """Remove the connection that has been idle longest, returning it. Must be
+    called with lock held."""
+    def remove_oldest(self):
+        s, (key, when) = self.order.popitem(last=False)
+        conns = self.idle[key]
+        conns.remove(s)
+        if not conns:
+            del self.idle[key]
+        return s
+
+    """Body of the reaper thread: close connections that have been idle for
+    more than idle_timeout seconds, until the pool is closed."""
+    def reap(self):
+        while not self.closed:
+            time.sleep(idle_timeout / 2)
+            expired = []
+            with self.lock:
+                oldest = time.monotonic() - idle_timeout
+                while self.order and next(iter(self.order.values()))[1] < oldest:
+                    expired.append(self.remove_oldest())
+            for s in expired:
+                s.close()
+
+    """Close all the idle connections. Connections given back afterwards are
+    closed right away."""
+    def close(self):
+        with self.lock:
+            self.closed = True
+            conns = list(self.order)
+            self.idle.clear()
+            self.order.clear()
+        for s in conns:
+            s.close()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.order)
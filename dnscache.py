@@ -0,0 +1,92 @@
+# dnscache.py module
+
+"""
+This module contains a small DNS cache for the workers. Looking up the same
+target host over and over again is slow, and that time shouldn't count towards
+the latency of every job. Answers are kept for as long as the DNS record's TTL
+says they are valid, and failed lookups are remembered for a few seconds so a
+burst of jobs for a bad host name doesn't hammer the resolver.
+
+If the dnspython package is installed, it is used to find out the real TTL of
+each record. Otherwise the system resolver is used (through socket) and every
+answer is kept for default_ttl seconds.
+
+Example usage:
+
+    import dnscache
+
+    ip = dnscache.resolve("www.google.com")   # raises socket.gaierror on failure
+    s.connect((ip, 80))
+"""
+
+import ipaddress
+import socket
+import threading
+import time
+
+try:
+    import dns.resolver # dnspython, if available, tells us the record TTLs
+except ImportError:
+    dns = None
+
+default_ttl = 60   # seconds to keep an answer when the real TTL is unknown
+min_ttl = 5        # never keep an answer for less than this many seconds
+max_ttl = 3600     # never keep an answer for more than this many seconds
+negative_ttl = 5   # seconds to remember that a lookup failed
+
+# Cached answers, keyed by lower-cased host name. Each value is a tuple
+# (expiry time, ip address, error), where exactly one of ip address and error
+# is None. These should only be touched with lock held.
+entries = {}
+lock = threading.Lock()
+
+"""Look up host in DNS, without using the cache. Returns a pair (ip, ttl)
+with the first IPv4 address found, or raises socket.gaierror. A host that is
+already an IPv4 address literal is returned as it is, without asking DNS. The
+workers only measure over IPv4, so an IPv6 literal is an error, like a name
+with no A record."""
+def lookup(host):
+    try:
+        addr = ipaddress.ip_address(host.strip("[]"))
+    except ValueError:
+        addr = None
+    if addr is not None:
+        if addr.version != 4:
+            raise socket.gaierror(socket.EAI_NONAME, "%s: not an IPv4 address" % (host))
+        return str(addr), max_ttl
+    if dns is not None:
+        try:
+            answer = dns.resolver.resolve(host, "A")
+            return answer[0].address, answer.rrset.ttl
+        except dns.exception.DNSException as e:
+            raise socket.gaierror(socket.EAI_NONAME, "%s: %s" % (host, e))
+    infos = socket.getaddrinfo(host, None, socket.AF_INET, socket.SOCK_STREAM)
+    return infos[0][4][0], default_ttl
+
+"""Return an IPv4 address for host, as a string, using the cache if possible.
+Raises socket.gaierror if the host can't be resolved."""
+def resolve(host):
+    key = host.lower()
+    now = time.monotonic()
+    with lock:
+        entry = entries.get(key)
+    if entry is not None and entry[0] > now:
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    try:
+        ip, ttl = lookup(host)
+    except socket.gaierror as e:
+        with lock:
+            entries[key] = (now + negative_ttl, None, e)
+        raise
+    ttl = max(min_ttl, min(max_ttl, ttl))
+    with lock:
+        entries[key] = (now + ttl, ip, None)
+    return ip
+
+"""Forget everything in the cache."""
+def clear():
+    with lock:
+        entries.clear()
@@ -0,0 +1,122 @@
+# estimator.py module
+
+"""
+This module turns the rtts measured by the workers into an estimate of where
+the target actually is, by multilateration. Nothing travels faster than light
+in fiber (about 2/3 of c), so an rtt of t seconds from a worker puts the target
+at most t/2 * 200,000 km away from it. Real paths are never straight lines, so
+we expect the target to be somewhat closer than that, at path_efficiency times
+the bound.
+
+The estimate is the point on the globe whose great-circle distances to the
+workers best match those expected distances, in a weighted least squares sense
+(closer workers get more weight, since their rtts are less distorted by
+routing), with a heavy penalty for violating any worker's speed-of-light bound.
+It is found with a vectorized search over a coarse grid covering the whole
+globe, then refined with a few Gauss-Newton steps. With a handful of workers
+this takes a few milliseconds, so it can be run on every request.
+
+The confidence radius comes from the speed-of-light bounds, not from how well
+the estimate fits: the target must be in the region that is within every
+worker's bound, so the radius is the distance from the estimate to the farthest
+grid point in that region. It is never more than the distance to the worker
+with the tightest bound plus that bound, which always holds, even if the bounds
+are inconsistent and the region is empty.
+
+Example usage:
+
+    import estimator
+
+    coords = [(38.13, -78.45), (51.51, -0.13), (-33.93, 18.42)]  # workers
+    rtts = [0.012, 0.081, 0.215]                                 # seconds
+    lat, lon, radius_km = estimator.estimate(coords, rtts)
+"""
+
+import functools
+
+import numpy as np
+
+import regionindex
+
+FIBER_KM_PER_S = 299792.458 * 2 / 3 # speed of light in fiber
+
+path_efficiency = 2 / 3 # fraction of the speed-of-light bound typical paths cover
+min_radius_km = 50.0    # never claim to be more precise than this
+bound_penalty = 10.0    # weight of violating a speed-of-light bound
+refine_steps = 10       # max number of Gauss-Newton steps
+grid_slack_km = 160.0   # about half the diagonal of a grid cell
+
+# Coarse grid of candidate points covering the globe, 2 degrees apart.
+grid_lat, grid_lon = np.meshgrid(np.arange(-89.0, 90.0, 2.0),
+                                 np.arange(-179.0, 180.0, 2.0), indexing="ij")
+grid_lat = grid_lat.ravel()
+grid_lon = grid_lon.ravel()
+
+# Great-circle distance in km, for numpy arrays of points given in degrees.
+distance_km = functools.partial(regionindex.distance_km, xp=np)
+
+"""Return the speed-of-light upper bound, in km, on the distance between a
+worker and the target for each rtt (in seconds)."""
+def distance_bounds(rtts):
+    return np.asarray(rtts, dtype=float) / 2 * FIBER_KM_PER_S
+
+"""Return the weighted residuals at each candidate point, as an array with one
+row per candidate and two columns per worker: the mismatch with the expected
+distance, and the amount by which the speed-of-light bound is exceeded."""
+def residuals(lat, lon, wlat, wlon, expected, bound, weight):
+    d = distance_km(lat[:, None], lon[:, None], wlat[None, :], wlon[None, :])
+    miss = (d - expected) * weight
+    excess = np.maximum(0.0, d - bound) * weight * bound_penalty
+    return np.concatenate([miss, excess], axis=1)
+
+"""Estimate the location of a target from the (lat, lon) coordinates of some
+workers and the rtt (in seconds) each measured to the target. Returns a tuple
+(lat, lon, radius_km), where the target is (as far as the speed of light is
+concerned) within radius_km of the estimate."""
+def estimate(coords, rtts):
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        raise ValueError("need at least one worker to estimate a location")
+    wlat, wlon = coords[:, 0], coords[:, 1]
+    bound = distance_bounds(rtts)
+    expected = bound * path_efficiency
+    weight = 1.0 / np.maximum(expected, min_radius_km)
+
+    if len(coords) == 1:
+        return float(wlat[0]), float(wlon[0]), float(max(bound[0], min_radius_km))
+
+    # Coarse search: evaluate the cost at every grid point at once.
+    r = residuals(grid_lat, grid_lon, wlat, wlon, expected, bound, weight)
+    best = np.argmin(np.sum(r * r, axis=1))
+    lat, lon = grid_lat[best], grid_lon[best]
+
+    # Refine with Gauss-Newton, using central differences for the Jacobian.
+    h = 1e-3
+    for i in range(refine_steps):
+        plat = np.array([lat, lat + h, lat - h, lat, lat])
+        plon = np.array([lon, lon, lon, lon + h, lon - h])
+        r = residuals(plat, plon, wlat, wlon, expected, bound, weight)
+        jac = np.stack([(r[1] - r[2]) / (2 * h), (r[3] - r[4]) / (2 * h)], axis=1)
+        step = np.linalg.lstsq(jac, -r[0], rcond=None)[0]
+        step = np.clip(step, -2.0, 2.0) # stay within the coarse grid cell or so
+        lat = float(np.clip(lat + step[0], -90.0, 90.0))
+        lon = float((lon + step[1] + 180.0) % 360.0 - 180.0)
+        if np.max(np.abs(step)) < 1e-4:
+            break
+
+    return lat, lon, float(max(feasible_radius(lat, lon, wlat, wlon, bound), min_radius_km))
+
+"""Return how far from (lat, lon) the target can be, given the speed-of-light
+bound from each worker: the distance to the farthest grid point that is within
+every bound (give or take a grid cell), or, if that is farther or there is no
+such point, the distance to the worker with the tightest bound plus that
+bound."""
+def feasible_radius(lat, lon, wlat, wlon, bound):
+    d = distance_km(lat, lon, wlat, wlon)
+    radius = np.min(d + bound)
+    to_workers = distance_km(grid_lat[:, None], grid_lon[:, None], wlat[None, :], wlon[None, :])
+    feasible = np.all(to_workers <= bound[None, :] + grid_slack_km, axis=1)
+    if np.any(feasible):
+        spread = np.max(distance_km(lat, lon, grid_lat[feasible], grid_lon[feasible]))
+        radius = min(radius, spread + grid_slack_km)
+    return radius
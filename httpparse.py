@@ -0,0 +1,227 @@
+# httpparse.py module
+
+"""
+This module contains an incremental parser for HTTP/1.x requests. It doesn't
+do any I/O itself: the connection handler feeds it whatever bytes arrive from
+the client, and asks it for the next request head, then for the body, and the
+parser says when it needs more data. This way the same parser works for both
+the threaded and the asyncio server modes.
+
+Everything is parsed as bytes, and the headers are put into a case-insensitive
+dict just once, so looking up a header is a single dict lookup. Bodies can be
+sent with a Content-Length, or with chunked transfer encoding, in which case
+the chunks are decoded as they arrive. Bytes that arrive after the end of one
+request are kept for the next one, so clients can pipeline requests. The size
+of the request head and body are limited, and violations are reported by
+raising HTTPError with the status code to send back.
+
+Example usage:
+
+    import httpparse
+
+    parser = httpparse.RequestParser()
+    head = parser.parse_head()          # None, not enough data yet
+    parser.feed(sock.recv(4096))
+    head = parser.parse_head()          # a RequestHead, or None if still incomplete
+    while not parser.body_done:
+        body_part = parser.read_body()  # b"" if more data needs to be fed
+        ...
+    leftover = parser.pending()         # start of the next request, if any
+"""
+
+max_head_size = 16 << 10 # max bytes in the request-line and headers
+max_body_size = 4 << 20  # max bytes in a request body (after decoding)
+max_headers = 100        # max number of header lines
+
+"""HTTPError is raised when a request is malformed, too big, or uses features
+we don't support. code is the status line to respond with, e.g. "400 BAD
+REQUEST". After an HTTPError, the connection should be closed, since there is
+no telling where the next request starts."""
+class HTTPError(Exception):
+
+    def __init__(self, code, msg):
+        Exception.__init__(self, msg)
+        self.code = code
+        self.msg = msg
+
+"""Headers is a dict of the request headers, keyed by lower-cased header name.
+If a header appears more than once, the values are joined with ", ". Lookups
+are case-insensitive."""
+class Headers(dict):
+
+    def get(self, key, default=None):
+        return dict.get(self, key.lower(), default)
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self, key.lower())
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key.lower())
+
+    def add(self, key, value):
+        key = key.lower()
+        if dict.__contains__(self, key):
+            dict.__setitem__(self, key, dict.__getitem__(self, key) + ", " + value)
+        else:
+            dict.__setitem__(self, key, value)
+
+"""RequestHead holds the parsed request-line and headers of one request, along
+with the raw bytes they were parsed from (without the blank line)."""
+class RequestHead:
+
+    def __init__(self, method, target, version, headers, raw):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+        self.raw = raw
+
+"""RequestParser parses a stream of requests from one client."""
+class RequestParser:
+
+    # States, for where we are within the current request.
+    HEAD = 0        # waiting for the request-line and headers
+    BODY = 1        # reading a body with a known length
+    CHUNK_SIZE = 2  # waiting for a chunk-size line
+    CHUNK_DATA = 3  # reading chunk data
+    CHUNK_END = 4   # waiting for the CRLF after chunk data
+    TRAILERS = 5    # reading trailer lines after the last chunk
+
+    def __init__(self):
+        self.buf = bytearray() # received data not yet consumed
+        self.state = self.HEAD
+        self.scanned = 0       # how much of buf was searched for the blank line
+        self.remaining = 0     # bytes left in the body or current chunk
+        self.body_size = 0     # decoded body bytes so far
+        self.body_done = True  # True once the current request's body is complete
+
+    """Add data received from the client."""
+    def feed(self, data):
+        self.buf += data
+
+    """Return (and forget) all data received but not yet parsed, e.g. the start
+    of the next pipelined request."""
+    def pending(self):
+        data = bytes(self.buf)
+        del self.buf[:]
+        self.scanned = 0
+        return data
+
+    """Parse the next request-line and headers, returning a RequestHead, or None
+    if more data is needed. The body, if any, should then be read with
+    read_body() until body_done is True, before calling this again. Raises
+    HTTPError if the request is malformed or too big."""
+    def parse_head(self):
+        if self.state != self.HEAD:
+            raise ValueError("the previous request's body has not been read")
+        # Only search the part of the buffer we haven't searched before.
+        end = self.buf.find(b"\r\n\r\n", max(0, self.scanned - 3))
+        if end < 0:
+            self.scanned = len(self.buf)
+            if len(self.buf) > max_head_size:
+                raise HTTPError("431 REQUEST HEADER FIELDS TOO LARGE", "Request headers are too large")
+            return None
+        if end > max_head_size:
+            raise HTTPError("431 REQUEST HEADER FIELDS TOO LARGE", "Request headers are too large")
+        raw = bytes(self.buf[:end])
+        del self.buf[:end+4]
+        self.scanned = 0
+
+        lines = raw.split(b"\r\n")
+        if len(lines) > max_headers + 1:
+            raise HTTPError("431 REQUEST HEADER FIELDS TOO LARGE", "Too many request headers")
+        words = lines[0].split()
+        if len(words) != 3 or not words[2].startswith(b"HTTP/"):
+            raise HTTPError("400 BAD REQUEST", "Your request-line is malformed!")
+        method, target, version = (w.decode("latin-1") for w in words)
+        headers = Headers()
+        for line in lines[1:]:
+            name, sep, value = line.partition(b":")
+            if not sep or not name or name != name.strip():
+                raise HTTPError("400 BAD REQUEST", "Malformed header line")
+            headers.add(name.decode("latin-1"), value.strip().decode("latin-1"))
+        self.start_body(headers)
+        return RequestHead(method, target, version, headers, raw)
+
+    """Work out how the body of a request with these headers is framed."""
+    def start_body(self, headers):
+        self.body_size = 0
+        self.body_done = False
+        te = headers.get("Transfer-Encoding")
+        cl = headers.get("Content-Length")
+        if te is not None:
+            if te.lower() != "chunked":
+                raise HTTPError("501 NOT IMPLEMENTED", "Unsupported transfer encoding: " + te)
+            if cl is not None:
+                raise HTTPError("400 BAD REQUEST", "Both Content-Length and Transfer-Encoding given")
+            self.state = self.CHUNK_SIZE
+        elif cl is not None:
+            if not (cl.isascii() and cl.isdigit()):
+                raise HTTPError("400 BAD REQUEST", "Malformed Content-Length")
+            self.remaining = int(cl)
+            if self.remaining > max_body_size:
+                raise HTTPError("413 PAYLOAD TOO LARGE", "Request body is too large")
+            self.state = self.BODY
+            if self.remaining == 0:
+                self.finish_body()
+        else:
+            self.finish_body()
+
+    """Get ready for the next request."""
+    def finish_body(self):
+        self.state = self.HEAD
+        self.body_done = True
+
+    """Return the next piece of the request body that is available, decoded,
+    as bytes. Returns b"" if more data needs to be fed first (or if the body is
+    done, see body_done). Raises HTTPError if the body is malformed or too
+    big."""
+    def read_body(self):
+        out = []
+        while not self.body_done:
+            if self.state in (self.BODY, self.CHUNK_DATA):
+                n = min(self.remaining, len(self.buf))
+                if n == 0:
+                    break
+                out.append(bytes(self.buf[:n]))
+                del self.buf[:n]
+                self.remaining -= n
+                if self.remaining == 0:
+                    if self.state == self.BODY:
+                        self.finish_body()
+                    else:
+                        self.state = self.CHUNK_END
+            elif self.state == self.CHUNK_END:
+                if len(self.buf) < 2:
+                    break
+                if self.buf[:2] != b"\r\n":
+                    raise HTTPError("400 BAD REQUEST", "Malformed chunked body")
+                del self.buf[:2]
+                self.state = self.CHUNK_SIZE
+            else: # CHUNK_SIZE or TRAILERS, both are line-based
+                i = self.buf.find(b"\r\n")
+                if i < 0:
+                    if len(self.buf) > max_head_size:
+                        raise HTTPError("400 BAD REQUEST", "Malformed chunked body")
+                    break
+                line = bytes(self.buf[:i])
+                del self.buf[:i+2]
+                if self.state == self.TRAILERS:
+                    if line == b"":
+                        self.finish_body()
+                    continue
+                try:
+                    size = int(line.split(b";", 1)[0].strip(), 16)
+                except ValueError:
+                    raise HTTPError("400 BAD REQUEST", "Malformed chunk size")
+                if size < 0:
+                    raise HTTPError("400 BAD REQUEST", "Malformed chunk size")
+                if size == 0:
+                    self.state = self.TRAILERS
+                    continue
+                if self.body_size + size > max_body_size:
+                    raise HTTPError("413 PAYLOAD TOO LARGE", "Request body is too large")
+                self.body_size += size
+                self.remaining = size
+                self.state = self.CHUNK_DATA
+        return b"".join(out)
@@ -0,0 +1,162 @@
+# logutil.py module
+
+"""
+This module contains a small logging subsystem for central. Printing straight
+to standard output from every connection handler is slow, and it serializes all
+the threads on stdout's lock, so instead each message is put on a queue along
+with its arguments, and a background writer thread formats the messages and
+writes them out in batches. Since the formatting happens on the writer thread,
+an expensive argument (like a printable dump of all the request headers) can be
+wrapped in Lazy() and it is only computed if the message is actually written.
+
+Every message has a level, and messages below the current level are dropped
+before anything is formatted or queued. Chatty messages that are logged for
+every request can also be sampled, so only one in every sample_rate of them is
+kept. If the writer falls behind and the queue fills up, messages are dropped
+(and counted) rather than slowing down the threads that log them.
+
+Example usage:
+
+    import logutil
+
+    logutil.level = logutil.DEBUG
+    logutil.info("Listening on %s:%d", host, port)
+    logutil.debug("Headers:\n%s", logutil.Lazy(make_printable, headers))
+    logutil.sampled("Done handling request %d", n)  # only 1 in sample_rate kept
+"""
+
+import atexit
+import itertools
+import queue
+import sys
+import threading
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+
+level = INFO       # messages below this level are dropped
+sample_rate = 1    # sampled() keeps one in every sample_rate messages
+max_queued = 10000 # messages waiting for the writer before we start dropping
+output = sys.stdout
+
+messages = queue.Queue(max_queued)
+dropped = 0 # messages lost because the queue was full, only the writer resets it
+sample_counter = itertools.count()
+writer = None
+writer_lock = threading.Lock()
+
+"""Lazy wraps a function and its arguments, and only calls it when the result
+is converted to a string, i.e. when a message using it is formatted."""
+class Lazy:
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return str(self.func(*self.args))
+
+"""Return True if messages at level lvl would be written."""
+def enabled(lvl):
+    return lvl >= level
+
+"""Queue a message at level lvl. msg is formatted as msg % args by the writer
+thread, if there are any args."""
+def log(lvl, msg, *args):
+    global dropped
+    if lvl < level:
+        return
+    if writer is None:
+        start()
+    try:
+        messages.put_nowait((threading.current_thread().name, msg, args))
+    except queue.Full:
+        dropped += 1
+
+def debug(msg, *args):
+    log(DEBUG, msg, *args)
+
+def info(msg, *args):
+    log(INFO, msg, *args)
+
+def warning(msg, *args):
+    log(WARNING, msg, *args)
+
+def error(msg, *args):
+    log(ERROR, msg, *args)
+
+"""Queue an info message, but only one in every sample_rate calls."""
+def sampled(msg, *args):
+    if INFO < level:
+        return
+    if sample_rate > 1 and next(sample_counter) % sample_rate != 0:
+        return
+    log(INFO, msg, *args)
+
+"""Format one queued message. Since multi-threading can jumble up the order of
+output, each line is prefixed with the name of the thread that logged it, and
+when printing multiple lines, each line after the first is indented a bit."""
+def format_message(name, msg, args):
+    try:
+        if args:
+            msg = msg % args
+        elif not isinstance(msg, str):
+            msg = str(msg)
+    except Exception as e:
+        msg = "%r %r (bad log message: %s)" % (msg, args, e)
+    linebreak = "\n" + (" " * len(name)) + ": "
+    return name + ": " + linebreak.join(msg.splitlines()) + "\n"
+
+"""Body of the writer thread: wait for a message, then write it along with
+everything else that is queued by then, in one go. A None message means stop."""
+def write_messages():
+    global dropped
+    running = True
+    while running:
+        batch = [messages.get()]
+        while True:
+            try:
+                batch.append(messages.get_nowait())
+            except queue.Empty:
+                break
+        lines = []
+        for m in batch:
+            if m is None:
+                running = False
+            else:
+                lines.append(format_message(*m))
+        if dropped > 0:
+            lines.append("logutil: %d messages were dropped\n" % (dropped))
+            dropped = 0
+        try:
+            output.write("".join(lines))
+            output.flush()
+        except (OSError, ValueError):
+            pass
+
+"""Start the writer thread, if it isn't already running."""
+def start():
+    global writer
+    with writer_lock:
+        if writer is None:
+            t = threading.Thread(target=write_messages, name="logwriter", daemon=True)
+            t.start()
+            writer = t
+
+"""Write out everything queued so far and stop the writer thread. Anything
+logged afterwards starts a new writer."""
+def flush():
+    global writer
+    with writer_lock:
+        t = writer
+        if t is None:
+            return
+        messages.put(None)
+        t.join()
+        writer = None
+
+atexit.register(flush)
@@ -0,0 +1,173 @@
+# measure.py module
+
+"""
+This module contains the rtt measurement engine used by the workers. There are
+several ways of measuring the round trip time to a web server, each with its
+own trade-offs:
+
+    "connect"  Time the TCP handshake, i.e. how long connect() takes. This is
+               one round trip with no server-side processing at all, so it is
+               the most accurate estimate of network distance.
+    "ttfb"     Time to first byte: open a fresh connection (not timed), send a
+               GET request, and time until the first byte of the response
+               arrives. Includes the server's time to start answering.
+    "head"     Send HEAD requests on one keep-alive connection and time until
+               the complete response headers arrive. Includes a little server
+               processing time, but no handshakes after the first. Afterwards
+               the connection goes back to the pool (see connpool.py), so
+               later probes of the same server needn't connect at all.
+
+The "connect" and "ttfb" modes need a fresh connection for every sample, by
+definition, so they never use the pool, and close each connection as soon as
+the sample is taken. All timing is done with time.perf_counter_ns(), and each
+mode takes several samples. Samples that fail (e.g. time out) are skipped. The
+results are rtts in seconds, and summarize() turns them into min / median / 90th
+percentile, which hold up much better against outliers than a plain mean does.
+
+Example usage:
+
+    import measure
+
+    rtts = measure.measure("142.250.80.36", "www.google.com", "/", mode="connect", samples=5)
+    low, median, p90 = measure.summarize(rtts)
+"""
+
+import socket
+import statistics
+import time
+
+import connpool
+import socketutil
+
+MODES = ("connect", "ttfb", "head")
+
+timeout = 5.0 # seconds to wait on any one sample before giving up on it
+
+# Idle keep-alive connections left over from "head" probes, for reuse.
+pool = connpool.Pool()
+
+"""Build an HTTP request for path on host, as bytes."""
+def build_request(method, host, path, keep_alive):
+    req = method + " " + path + " HTTP/1.1\r\n"
+    req += "Host: " + host + "\r\n"
+    req += "Accept: text/html\r\n"
+    req += "Connection: " + ("keep-alive" if keep_alive else "close") + "\r\n\r\n"
+    return req.encode()
+
+"""Open a new connection to (ip, port), with the module's timeout."""
+def open_connection(ip, port):
+    s = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.settimeout(timeout)
+    s.connect((ip, port))
+    return s
+
+"""Take one "connect" sample, returning the rtt in nanoseconds."""
+def sample_connect(ip, port):
+    s = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        start = time.perf_counter_ns()
+        s.connect((ip, port))
+        return time.perf_counter_ns() - start
+    finally:
+        s.close()
+
+"""Take one "ttfb" sample, returning the rtt in nanoseconds."""
+def sample_ttfb(ip, port, req):
+    s = open_connection(ip, port)
+    try:
+        start = time.perf_counter_ns()
+        s.sendall(req)
+        if not s.recv(1):
+            raise ConnectionError("connection closed before first byte")
+        return time.perf_counter_ns() - start
+    finally:
+        s.close()
+
+"""Return True if the server will keep the connection open after sending a
+response with these headers (given as raw bytes, without the blank line)."""
+def keeps_alive(headers):
+    headers = headers.lower()
+    if b"\r\nconnection: close" in headers:
+        return False
+    if headers.startswith(b"http/1.0"):
+        return b"\r\nconnection: keep-alive" in headers
+    return True
+
+"""Take all the "head" samples on as few connections as possible, returning a
+list of rtts in nanoseconds. An idle connection from the pool is used if there
+is one, and a new connection (not timed) is only opened when there isn't, or
+the server closes the previous one. If the server closes a pooled connection
+just as we use it, the sample is taken again on a new connection. The last
+connection goes back to the pool if the server is keeping it open."""
+def samples_head(ip, port, req, n):
+    rtts = []
+    s = pool.get(ip, port)
+    reused = s is not None
+    try:
+        i = 0
+        while i < n:
+            try:
+                if s is None:
+                    s = open_connection(ip, port)
+                    reused = False
+                start = time.perf_counter_ns()
+                s.sendall(req)
+                headers = s.recv_until(b"\r\n\r\n")
+                end = time.perf_counter_ns()
+                if headers is None:
+                    raise ConnectionError("connection closed before response")
+                rtts.append(end - start)
+                if not keeps_alive(headers):
+                    s.close()
+                    s = None
+            except OSError:
+                if s is not None:
+                    s.close()
+                    s = None
+                if reused:
+                    reused = False
+                    continue # the pooled connection went stale, try again
+            i += 1
+    except:
+        if s is not None:
+            s.close()
+        raise
+    if s is not None:
+        pool.put(ip, port, s)
+    return rtts
+
+"""Measure the rtt to a web server at ip, taking the given number of samples
+with the given mode. host and path are used for the HTTP requests in the
+"ttfb" and "head" modes. Returns the list of rtts in seconds, or raises
+OSError if no sample at all could be taken."""
+def measure(ip, host, path, mode="connect", samples=5, port=80):
+    rtts = []
+    if mode == "connect":
+        for i in range(samples):
+            try:
+                rtts.append(sample_connect(ip, port))
+            except OSError:
+                pass
+    elif mode == "ttfb":
+        req = build_request("GET", host, path, False)
+        for i in range(samples):
+            try:
+                rtts.append(sample_ttfb(ip, port, req))
+            except OSError:
+                pass
+    elif mode == "head":
+        req = build_request("HEAD", host, path, True)
+        rtts = samples_head(ip, port, req, samples)
+    else:
+        raise ValueError("unknown measurement mode: %r" % (mode))
+    if len(rtts) == 0:
+        raise OSError("no %s samples could be taken from %s" % (mode, ip))
+    return [ns / 1e9 for ns in rtts]
+
+"""Return a tuple (min, median, p90) summarizing a non-empty list of rtts. The
+90th percentile is found by the nearest-rank method."""
+def summarize(rtts):
+    ordered = sorted(rtts)
+    rank = max(0, -(-9 * len(ordered) // 10) - 1) # ceil(0.9 * n) - 1
+    return ordered[0], statistics.median(ordered), ordered[rank]
@@ -0,0 +1,200 @@
+# metrics.py module
+
+"""
+This module contains counters, gauges, and histograms for keeping track of how
+central is doing, and renders them in the Prometheus text exposition format so
+they can be scraped from central's /metrics page.
+
+Metrics are updated by every connection handler thread, so to keep them from
+serializing all the threads on one lock, each metric's values are split into a
+fixed number of stripes, each with its own lock. Every thread is assigned one
+stripe (round-robin, the first time it updates anything) and only ever updates
+that one, so threads rarely contend with each other. Reading a metric adds up
+all the stripes. The number of stripes is fixed rather than one per thread,
+since in threaded mode central starts a new thread for every connection.
+
+Every metric can have labels, given as a tuple of label names when it is
+created. Values for the labels are passed to each update, in the same order.
+Gauges whose value is easy to compute when scraped (like the size of a list)
+can be given a function instead of being updated.
+
+Example usage:
+
+    import metrics
+
+    requests = metrics.Counter("requests_total", "Requests handled.", ("route",))
+    latency = metrics.Histogram("request_seconds", "Time per request.", ("route",))
+    workers = metrics.Gauge("workers", "Connected workers.", func=lambda: len(w))
+
+    requests.inc(1, "/analyze")
+    latency.observe(0.012, "/analyze")
+    text = metrics.render()
+"""
+
+import bisect
+import itertools
+import math
+import threading
+
+STRIPES = 16
+
+# Default histogram buckets, in seconds, from 1 ms up to 10 seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# All metrics, in the order they were created, for render().
+registry = []
+
+thread_slot = threading.local()
+next_slot = itertools.count()
+
+"""Return the stripe index assigned to the current thread."""
+def stripe_index():
+    try:
+        return thread_slot.index
+    except AttributeError:
+        thread_slot.index = next(next_slot) % STRIPES
+        return thread_slot.index
+
+"""Format a float the way Prometheus expects."""
+def format_value(v):
+    if v == math.inf:
+        return "+Inf"
+    if isinstance(v, int) or float(v).is_integer():
+        return str(int(v))
+    return repr(float(v))
+
+"""Format a set of labels, as in {route="/analyze",code="200"}."""
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for (name, value) in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append('%s="%s"' % (name, value))
+    return "{" + ",".join(pairs) + "}"
+
+"""Metric is the base for all kinds of metrics. Each stripe is a pair
+(lock, values), where values maps a tuple of label values to whatever the
+kind of metric keeps for them."""
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.stripes = [(threading.Lock(), {}) for i in range(STRIPES)]
+        registry.append(self)
+
+    """Return the current values, merged over all stripes, as a dict mapping
+    each tuple of label values to its value."""
+    def collect(self):
+        merged = {}
+        for (lock, values) in self.stripes:
+            with lock:
+                for (key, value) in values.items():
+                    if key in merged:
+                        merged[key] = self.merge(merged[key], value)
+                    else:
+                        merged[key] = self.copy(value)
+        return merged
+
+    def merge(self, a, b):
+        return a + b
+
+    def copy(self, value):
+        return value
+
+    """Return the lines for this metric in the text exposition format."""
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for (key, value) in sorted(self.collect().items()):
+            lines.append("%s%s %s" % (self.name, format_labels(self.labels, key), format_value(value)))
+        return lines
+
+"""Counter is a value that only goes up, like the number of requests."""
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, *labels):
+        lock, values = self.stripes[stripe_index()]
+        with lock:
+            values[labels] = values.get(labels, 0) + amount
+
+    """Return the total, over all stripes, for the given label values."""
+    def value(self, *labels):
+        return self.collect().get(labels, 0)
+
+"""Gauge is a value that can go up and down, like the number of active
+connections. If func is given, the gauge's value is whatever func() returns
+when the metrics are rendered, and it has no labels."""
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), func=None):
+        Counter.__init__(self, name, help, () if func else labels)
+        self.func = func
+
+    def dec(self, amount=1, *labels):
+        self.inc(-amount, *labels)
+
+    def collect(self):
+        if self.func is not None:
+            return {(): self.func()}
+        return Counter.collect(self)
+
+"""Histogram counts observations (like request durations) in buckets, so that
+percentiles can be estimated from them. Each value is a list with a count per
+bucket (not cumulative), then the sum and the count of all observations."""
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, amount, *labels):
+        i = bisect.bisect_left(self.buckets, amount)
+        lock, values = self.stripes[stripe_index()]
+        with lock:
+            counts = values.get(labels)
+            if counts is None:
+                counts = values[labels] = [0] * (len(self.buckets) + 2)
+            counts[i] += 1
+            counts[-2] += amount
+            counts[-1] += 1
+
+    def merge(self, a, b):
+        for i in range(len(a)):
+            a[i] += b[i]
+        return a
+
+    def copy(self, value):
+        return list(value)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        names = self.labels + ("le",)
+        for (key, counts) in sorted(self.collect().items()):
+            total = 0
+            for (i, bound) in enumerate(self.buckets):
+                total += counts[i]
+                lines.append("%s_bucket%s %d" % (self.name,
+                        format_labels(names, key + (format_value(bound),)), total))
+            labels = format_labels(self.labels, key)
+            lines.append("%s_sum%s %s" % (self.name, labels, format_value(counts[-2])))
+            lines.append("%s_count%s %d" % (self.name, labels, counts[-1]))
+        return lines
+
+"""Render all metrics in the Prometheus text exposition format."""
+def render():
+    lines = []
+    for metric in registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+"""Mime type for the output of render()."""
+CONTENT_TYPE = "text/plain; version=0.0.4"
@@ -0,0 +1,194 @@
+# prefixindex.py module
+
+"""
+This module contains an index of estimated locations by IP address prefix.
+Many of the targets people ask central about sit behind the same CDN or
+hosting provider, in the same address range, so once one of them has been
+located, the location of its neighbours is usually known too. Central adds the
+estimate from every completed analysis here, under the prefix of the target's
+address (a /24 for IPv4, a /48 for IPv6, by default), and before sending any
+jobs to the workers it looks up the target's address here first.
+
+Lookups find the longest prefix that contains the address, using a binary
+radix (patricia) trie per address family: each node holds a prefix, and only
+nodes where the prefixes in it branch off are kept, so a lookup takes at most
+one step per stored prefix length rather than one per address bit.
+
+Each location comes with how sure we are about it: the radius of the estimate
+and the number of workers that measured the target. Old locations are ignored
+by lookups (how old is up to the caller), and once there are more than
+max_entries prefixes the oldest ones are forgotten.
+
+Example usage:
+
+    import prefixindex
+
+    index = prefixindex.PrefixIndex()
+    index.add("93.184.216.34", 40.7, -74.0, 150, 6)
+    hit = index.lookup("93.184.216.99", max_age=3600)
+    if hit is not None:
+        prefix, loc = hit     # "93.184.216.0/24", a Location
+"""
+
+import ipaddress
+import threading
+import time
+
+ipv4_prefix = 24       # length of the prefix locations are stored under, for IPv4
+ipv6_prefix = 48       # the same, for IPv6
+max_entries = 100000   # forget the oldest prefixes beyond this many
+
+"""Location is an estimated location for a prefix, with the radius (in km) of
+the estimate, the number of workers that measured it, and when it was made."""
+class Location:
+    __slots__ = ("lat", "lon", "radius_km", "workers", "updated")
+
+    def __init__(self, lat, lon, radius_km, workers, updated):
+        self.lat = lat
+        self.lon = lon
+        self.radius_km = radius_km
+        self.workers = workers
+        self.updated = updated
+
+"""Node is one node of a PrefixTrie: the first length bits of bits, and the
+value stored for that prefix, if any."""
+class Node:
+    __slots__ = ("bits", "length", "value", "children")
+
+    def __init__(self, bits, length, value=None):
+        self.bits = bits
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+"""PrefixTrie maps prefixes of width-bit addresses to values. Addresses and
+prefixes are given as ints, with a prefix's bits at the top, like an address
+with the rest of the bits zero."""
+class PrefixTrie:
+
+    def __init__(self, width):
+        self.width = width
+        self.root = Node(0, 0)
+        self.size = 0
+
+    """Return the int with the top length bits set."""
+    def mask(self, length):
+        return ((1 << length) - 1) << (self.width - length)
+
+    """Return bit i of addr, counting from the top."""
+    def bit(self, addr, i):
+        return (addr >> (self.width - 1 - i)) & 1
+
+    """Store value for the first length bits of addr."""
+    def insert(self, addr, length, value):
+        addr &= self.mask(length)
+        node = self.root
+        while True:
+            if node.length == length:
+                if node.value is None:
+                    self.size += 1
+                node.value = value
+                return
+            b = self.bit(addr, node.length)
+            child = node.children[b]
+            if child is None:
+                node.children[b] = Node(addr, length, value)
+                self.size += 1
+                return
+            # How many leading bits do the child's prefix and ours share?
+            common = min(child.length, length)
+            diff = (child.bits ^ addr) & self.mask(common)
+            if diff != 0:
+                common = self.width - diff.bit_length()
+            if common == child.length:
+                node = child
+                continue
+            # Split the child's path where ours branches off of it.
+            mid = Node(addr & self.mask(common), common)
+            node.children[b] = mid
+            mid.children[self.bit(child.bits, common)] = child
+            if common == length:
+                mid.value = value
+            else:
+                mid.children[self.bit(addr, common)] = Node(addr, length, value)
+            self.size += 1
+            return
+
+    """Return a list of (length, value) for every stored prefix that contains
+    addr, longest last."""
+    def matches(self, addr):
+        found = []
+        node = self.root
+        while node is not None:
+            if (addr & self.mask(node.length)) != node.bits:
+                break
+            if node.value is not None:
+                found.append((node.length, node.value))
+            if node.length == self.width:
+                break
+            node = node.children[self.bit(addr, node.length)]
+        return found
+
+    """Yield (prefix bits, length, value) for every stored prefix."""
+    def items(self):
+        todo = [self.root]
+        while todo:
+            node = todo.pop()
+            if node.value is not None:
+                yield (node.bits, node.length, node.value)
+            todo.extend(c for c in node.children if c is not None)
+
+    def __len__(self):
+        return self.size
+
+"""PrefixIndex holds the estimated locations for IPv4 and IPv6 prefixes. All
+methods are thread-safe."""
+class PrefixIndex:
+
+    def __init__(self):
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.lock = threading.Lock()
+
+    """Store an estimated location for the prefix containing ip. Invalid
+    addresses are ignored."""
+    def add(self, ip, lat, lon, radius_km, workers):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return
+        length = ipv4_prefix if addr.version == 4 else ipv6_prefix
+        loc = Location(lat, lon, radius_km, workers, time.time())
+        with self.lock:
+            self.tries[addr.version].insert(int(addr), length, loc)
+            if len(self) > max_entries:
+                self.prune(max_entries * 3 // 4)
+
+    """Return a pair (prefix, Location) for the longest prefix containing ip
+    whose location is at most max_age seconds old, or None."""
+    def lookup(self, ip, max_age):
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        oldest = time.time() - max_age
+        with self.lock:
+            found = self.tries[addr.version].matches(int(addr))
+        for (length, loc) in reversed(found):
+            if loc.updated >= oldest:
+                net = ipaddress.ip_network((int(addr), addr.max_prefixlen), strict=False).supernet(new_prefix=length)
+                return str(net), loc
+        return None
+
+    """Keep only the keep most recently updated prefixes. Must be called with
+    lock held."""
+    def prune(self, keep):
+        entries = []
+        for (version, trie) in self.tries.items():
+            entries.extend((loc.updated, version, bits, length, loc) for (bits, length, loc) in trie.items())
+        entries.sort(key=lambda e: e[0], reverse=True)
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        for (updated, version, bits, length, loc) in entries[:keep]:
+            self.tries[version].insert(bits, length, loc)
+
+    def __len__(self):
+        return sum(len(t) for t in self.tries.values())
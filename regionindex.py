@@ -0,0 +1,116 @@
+# regionindex.py module
+
+"""
+This module precomputes geometry over all the AWS and GCP regions listed in
+cloud.py, so that the estimator and worker-selection code can ask spatial
+questions on every request without redoing any trigonometry. When imported, it
+builds:
+
+  * a great-circle distance matrix between all pairs of regions, which central
+    uses to spread out the workers it picks, since every worker runs in (or is
+    matched to) one of these regions, and
+  * a ball tree over the regions' positions, for answering "which regions are
+    nearest to this point?", which central uses to find the workers nearest an
+    estimated location, and to name the region nearest an estimate.
+
+The ball tree works on 3D unit vectors rather than (lat, lon) pairs. The
+straight-line (chord) distance between two unit vectors grows with the
+great-circle distance between the points, so it can be used for pruning, and
+unlike lat/lon it has no trouble at the poles or the date line.
+
+Example usage:
+
+    import regionindex
+
+    regionindex.region_distance("us-east-1", "eu-west-2")   # about 6000 km
+    regionindex.nearest(41.88, -87.63, k=3)   # [(km, region), ...] closest first
+"""
+
+import heapq
+import math
+
+import cloud
+
+EARTH_RADIUS_KM = 6371.0
+LEAF_SIZE = 4 # max number of regions in a ball tree leaf
+
+"""Great-circle (haversine) distance in km between two points given in
+degrees. Given xp=numpy, the arguments can be numpy arrays instead of floats,
+and are broadcast against each other."""
+def distance_km(lat1, lon1, lat2, lon2, xp=math):
+    lat1, lon1, lat2, lon2 = (xp.radians(x) for x in (lat1, lon1, lat2, lon2))
+    a = (xp.sin((lat2 - lat1) / 2) ** 2 +
+         xp.cos(lat1) * xp.cos(lat2) * xp.sin((lon2 - lon1) / 2) ** 2)
+    a = min(1.0, a) if xp is math else xp.minimum(1.0, a) # rounding can push it past 1
+    return 2 * EARTH_RADIUS_KM * xp.asin(xp.sqrt(a))
+
+"""Unit vector (x, y, z) for a point given in degrees."""
+def unit_vector(lat, lon):
+    lat, lon = math.radians(lat), math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+"""Chord length between two unit vectors."""
+def chord(u, v):
+    return math.sqrt((u[0]-v[0])**2 + (u[1]-v[1])**2 + (u[2]-v[2])**2)
+
+"""A node in the ball tree. Every region below this node is within radius
+(chord length) of center. Leaves hold a list of region indexes, inner nodes
+have exactly two children."""
+class Ball:
+    def __init__(self, members):
+        n = len(members)
+        self.center = tuple(sum(vectors[i][d] for i in members) / n for d in range(3))
+        self.radius = max(chord(self.center, vectors[i]) for i in members)
+        self.members = None
+        self.children = None
+        if n <= LEAF_SIZE:
+            self.members = members
+            return
+        # Split along the axis where the regions are most spread out.
+        spread = [max(vectors[i][d] for i in members) - min(vectors[i][d] for i in members)
+                  for d in range(3)]
+        axis = spread.index(max(spread))
+        ordered = sorted(members, key=lambda i: vectors[i][axis])
+        self.children = (Ball(ordered[:n//2]), Ball(ordered[n//2:]))
+
+    """Lower bound on the chord distance from u to any region in this ball."""
+    def min_chord(self, u):
+        return max(0.0, chord(u, self.center) - self.radius)
+
+# Everything below is computed once, when the module is imported.
+regions = list(cloud.regions)
+index_of = {r: i for (i, r) in enumerate(regions)}
+coords = [cloud.region_coords[r] for r in regions]
+vectors = [unit_vector(lat, lon) for (lat, lon) in coords]
+distance_matrix = [[distance_km(a[0], a[1], b[0], b[1]) for b in coords] for a in coords]
+tree = Ball(list(range(len(regions))))
+
+"""Great-circle distance in km between two regions, by name."""
+def region_distance(a, b):
+    return distance_matrix[index_of[a]][index_of[b]]
+
+"""Return the k regions nearest to a point, as a list of (distance_km, region)
+pairs, closest first."""
+def nearest(lat, lon, k=1):
+    if k <= 0:
+        return []
+    u = unit_vector(lat, lon)
+    best = [] # max-heap of (-chord, index) for the k closest so far
+    todo = [(tree.min_chord(u), 0, tree)] # min-heap of balls still to visit
+    counter = 1
+    while todo:
+        bound, _, ball = heapq.heappop(todo)
+        if len(best) == k and bound > -best[0][0]:
+            break
+        if ball.members is not None:
+            for i in ball.members:
+                c = chord(u, vectors[i])
+                if len(best) < k:
+                    heapq.heappush(best, (-c, i))
+                elif c < -best[0][0]:
+                    heapq.heapreplace(best, (-c, i))
+        else:
+            for child in ball.children:
+                heapq.heappush(todo, (child.min_chord(u), counter, child))
+                counter += 1
+    return sorted((distance_km(lat, lon, coords[i][0], coords[i][1]), regions[i]) for (c, i) in best)
@@ -0,0 +1,312 @@
+# rttstore.py module
+
+"""
+This module contains an append-only store for the rtt measurements that
+workers send to central, so they can be used again later (to estimate where a
+target is without probing it again, or for analytics) instead of being
+thrown away once the analysis they were taken for is done.
+
+Measurements are buffered in memory, and every block_rows of them (or every
+flush_interval seconds) they are appended to the current segment file as one
+block. Within a block the data is stored by column rather than by row: all the
+timestamps, then all the target IPs, then all the worker indexes, then the
+sample offsets, then all the samples themselves. Looking up a target IP only
+has to search the IP column, which is one contiguous run of 16-byte addresses
+(IPv4 addresses are stored IPv4-mapped). Each block starts with a header
+holding its row count and time range, so blocks that are too old can be
+skipped without reading them, and a small table of the workers that appear in
+it.
+
+Once a segment file reaches segment_bytes, a new one is started, and beyond
+max_segments the oldest segment is deleted, so the store's disk use is bounded
+too. Segments are read through mmap, so reading history doesn't need memory
+beyond the page cache. Numbers are stored in the machine's native byte order.
+A block that was only partly written (e.g. central crashed) is ignored. When
+the store is opened again, the newest segment is cut back to its last complete
+block and appended to, unless it is full, so restarting central doesn't leave
+a trail of small segments behind. Only files named like segments (a number
+and ".rtt") in the store's directory are taken to be segments.
+
+Example usage:
+
+    import rttstore
+
+    store = rttstore.Store("./rtt_store")
+    store.append(1, "Chicago", "(41.88, -87.63)", "93.184.216.34", time.time(), rtts)
+    for (worker, t, rtts) in store.lookup("93.184.216.34", since=time.time() - 3600):
+        worker_id, location, coords = worker
+    store.close()
+"""
+
+import array
+import ipaddress
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+segment_bytes = 64 << 20 # start a new segment once the current one is this big
+max_segments = 16        # delete the oldest segments beyond this many
+block_rows = 1024        # measurements buffered before writing a block
+flush_interval = 5.0     # seconds a measurement can stay buffered
+
+MAGIC = b"RTB1"
+# magic, rows, samples, length of worker table, first time, last time
+HEADER = struct.Struct("=4sIIIdd")
+IPV4_MAPPED = b"\0" * 10 + b"\xff\xff"
+SEGMENT_NAME = re.compile(r"^[0-9]+\.rtt$")
+
+"""Round n up to a multiple of 8, so every column starts aligned."""
+def pad8(n):
+    return (n + 7) & ~7
+
+"""Return an IP address as 16 bytes, or None if it isn't a valid address."""
+def pack_ip(ip):
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if addr.version == 4:
+        return IPV4_MAPPED + addr.packed
+    return addr.packed
+
+"""Return the IP address string for 16 packed bytes."""
+def unpack_ip(data):
+    if data[:12] == IPV4_MAPPED:
+        return str(ipaddress.IPv4Address(data[12:]))
+    return str(ipaddress.IPv6Address(data))
+
+"""Layout holds the offsets of each column within a block, given its header."""
+class Layout:
+
+    def __init__(self, pos, rows, samples, table_len):
+        self.table = pos + HEADER.size
+        self.times = self.table + pad8(table_len)
+        self.ips = self.times + 8 * rows
+        self.workers = self.ips + 16 * rows
+        self.offsets = self.workers + pad8(2 * rows)
+        self.samples = self.offsets + pad8(4 * (rows + 1))
+        self.end = self.samples + pad8(4 * samples)
+
+"""Encode a list of rows (worker, packed ip, time, rtts) as one block."""
+def encode_block(rows):
+    table = []
+    index = {}
+    times = array.array("d")
+    workers = array.array("H")
+    offsets = array.array("I", [0])
+    samples = array.array("f")
+    for (worker, ip, t, rtts) in rows:
+        if worker not in index:
+            index[worker] = len(table)
+            table.append(worker)
+        times.append(t)
+        workers.append(index[worker])
+        samples.extend(rtts)
+        offsets.append(len(samples))
+    table = json.dumps(table).encode()
+    parts = [HEADER.pack(MAGIC, len(rows), len(samples), len(table), times[0], times[-1]),
+             table, times.tobytes(), b"".join(row[1] for row in rows),
+             workers.tobytes(), offsets.tobytes(), samples.tobytes()]
+    out = bytearray()
+    for p in parts:
+        out += p
+        out += b"\0" * (pad8(len(out)) - len(out))
+    return bytes(out)
+
+"""Segment is one segment file. Its blocks are indexed as they are found, and
+the file is mmapped again whenever it has grown. Old mmaps are never closed
+explicitly, so a reader still using one is never cut off; they are closed when
+nobody uses them any more."""
+class Segment:
+
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.blocks = [] # (Layout, rows, first time, last time, worker table)
+        self.indexed = 0 # how much of the file has been indexed
+        self.lock = threading.Lock()
+
+    """Return the mmap of the file and the list of its complete blocks."""
+    def view(self):
+        with self.lock:
+            try:
+                size = os.path.getsize(self.path)
+            except OSError:
+                return None, []
+            if size > 0 and (self.mm is None or len(self.mm) < size):
+                with open(self.path, "rb") as f:
+                    self.mm = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            mm = self.mm
+            while mm is not None and self.indexed + HEADER.size <= len(mm):
+                magic, rows, samples, table_len, first, last = HEADER.unpack_from(mm, self.indexed)
+                if magic != MAGIC:
+                    break
+                layout = Layout(self.indexed, rows, samples, table_len)
+                if layout.end > len(mm):
+                    break # not all written yet
+                workers = [tuple(w) for w in json.loads(mm[layout.table:layout.table+table_len])]
+                self.blocks.append((layout, rows, first, last, workers))
+                self.indexed = layout.end
+            return mm, list(self.blocks)
+
+"""Open the segment file at path for appending, first cutting off anything
+after its last complete block."""
+def reopen(path):
+    segment = Segment(path)
+    mm, blocks = segment.view()
+    if mm is not None:
+        mm.close() # nobody else has seen this mmap
+    f = open(path, "ab")
+    f.truncate(segment.indexed)
+    return f
+
+"""Store holds all the measurements in one directory."""
+class Store:
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        names = sorted((n for n in os.listdir(path) if SEGMENT_NAME.match(n)), key=lambda n: int(n[:-4]))
+        for n in names:
+            if os.path.getsize(os.path.join(path, n)) == 0:
+                os.remove(os.path.join(path, n)) # left by an earlier run that stored nothing
+        names = [n for n in names if os.path.exists(os.path.join(path, n))]
+        self.next_seq = int(names[-1][:-4]) + 1 if names else 1
+        self.file = None
+        self.buffer = []       # rows not yet written
+        self.writing = []      # rows being written right now
+        self.buffered_since = None
+        self.lock = threading.Lock()       # protects buffer, writing, segments
+        self.write_lock = threading.Lock() # protects the current file
+        if names and os.path.getsize(os.path.join(path, names[-1])) < segment_bytes:
+            self.file = reopen(os.path.join(path, names[-1]))
+        self.segments = [Segment(os.path.join(path, n)) for n in names]
+        if self.file is None:
+            self.rotate()
+
+    """Start a new segment file, deleting the oldest ones if there are too
+    many. Must be called with write_lock held (or from __init__)."""
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        name = os.path.join(self.path, "%08d.rtt" % (self.next_seq))
+        self.next_seq += 1
+        self.file = open(name, "ab")
+        with self.lock:
+            self.segments.append(Segment(name))
+            while len(self.segments) > max_segments:
+                old = self.segments.pop(0)
+                try:
+                    os.remove(old.path)
+                except OSError:
+                    pass
+
+    """Add one measurement: the worker (its ID, location, and coordinates),
+    the target's IP address, the time it was taken, and the rtt samples in
+    seconds. Measurements with an invalid IP address are ignored."""
+    def append(self, worker_id, location, coords, ip, t, rtts):
+        packed = pack_ip(ip)
+        if packed is None:
+            return
+        with self.lock:
+            if not self.buffer:
+                self.buffered_since = time.monotonic()
+            self.buffer.append(((worker_id, location, coords), packed, t, rtts))
+            full = len(self.buffer) >= block_rows
+            stale = time.monotonic() - self.buffered_since >= flush_interval
+        if full or stale:
+            self.flush()
+
+    """Write out the buffered measurements if the oldest of them has waited
+    flush_interval seconds. Call this now and then, so measurements don't stay
+    only in memory for long when few of them arrive."""
+    def flush_stale(self):
+        with self.lock:
+            stale = self.buffer and time.monotonic() - self.buffered_since >= flush_interval
+        if stale:
+            self.flush()
+
+    """Write all buffered measurements out as a block."""
+    def flush(self):
+        with self.write_lock:
+            with self.lock:
+                rows, self.buffer = self.buffer, []
+                self.writing = rows
+            if not rows or self.file is None:
+                return
+            try:
+                self.file.write(encode_block(rows))
+                self.file.flush()
+                if self.file.tell() >= segment_bytes:
+                    self.rotate()
+            finally:
+                with self.lock:
+                    self.writing = []
+
+    """Return all measurements of the target ip taken at or after time since,
+    oldest first, as a list of tuples (worker, time, rtts), where worker is a
+    tuple (ID, location, coordinates)."""
+    def lookup(self, ip, since=0):
+        packed = pack_ip(ip)
+        if packed is None:
+            return []
+        found = []
+        with self.lock:
+            segments = list(self.segments)
+            recent = self.writing + self.buffer
+        for segment in segments:
+            mm, blocks = segment.view()
+            for (layout, rows, first, last, workers) in blocks:
+                if last < since:
+                    continue
+                # Search the IP column for the address, 16 bytes at a time.
+                pos = mm.find(packed, layout.ips, layout.workers)
+                while pos >= 0:
+                    i, misaligned = divmod(pos - layout.ips, 16)
+                    if misaligned == 0:
+                        (t,) = struct.unpack_from("d", mm, layout.times + 8*i)
+                        if t >= since:
+                            (w,) = struct.unpack_from("H", mm, layout.workers + 2*i)
+                            a, b = struct.unpack_from("II", mm, layout.offsets + 4*i)
+                            rtts = array.array("f", mm[layout.samples+4*a:layout.samples+4*b])
+                            found.append((workers[w], t, list(rtts)))
+                    pos = mm.find(packed, pos + 1, layout.workers)
+        for (worker, ip16, t, rtts) in recent:
+            if ip16 == packed and t >= since:
+                found.append((worker, t, list(rtts)))
+        return found
+
+    """Yield every stored measurement taken at or after time since, as tuples
+    (worker, ip, time, rtts), oldest first (except for ones being written)."""
+    def scan(self, since=0):
+        with self.lock:
+            segments = list(self.segments)
+            recent = self.writing + self.buffer
+        for segment in segments:
+            mm, blocks = segment.view()
+            for (layout, rows, first, last, workers) in blocks:
+                if last < since:
+                    continue
+                times = array.array("d", mm[layout.times:layout.ips])
+                offsets = array.array("I", mm[layout.offsets:layout.offsets+4*(rows+1)])
+                samples = array.array("f", mm[layout.samples:layout.samples+4*offsets[-1]])
+                for i in range(rows):
+                    if times[i] >= since:
+                        (w,) = struct.unpack_from("H", mm, layout.workers + 2*i)
+                        ip = unpack_ip(mm[layout.ips+16*i:layout.ips+16*i+16])
+                        yield (workers[w], ip, times[i], list(samples[offsets[i]:offsets[i+1]]))
+        for (worker, ip16, t, rtts) in recent:
+            if t >= since:
+                yield (worker, unpack_ip(ip16), t, list(rtts))
+
+    """Write out anything buffered and close the current segment."""
+    def close(self):
+        self.flush()
+        with self.write_lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
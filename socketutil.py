@@ -34,6 +34,14 @@ def create_connection(address, timeout=None, source_address=None):
     s = _socket.create_connection(address, timeout, source_address)
     return socket(s)
 
+# Received data that hasn't been returned to the caller yet is kept in a
+# growable bytearray, rather than an immutable bytes object, so that appending
+# newly received data or consuming data from the front doesn't copy everything
+# else that is buffered. New data is received straight into the spare room at
+# the end of the buffer with recv_into().
+RECV_CHUNK = 4096         # how much to ask the kernel for at a time
+MAX_IDLE_BUFFER = 1 << 16 # drop buffers bigger than this once they are empty
+
 """Socket wrapper class, extends _socket.socket with new features."""
 class socket(_socket.socket):
 
@@ -43,7 +51,9 @@ class socket(_socket.socket):
             _socket.socket.__init__(self, family, type)
         else:
             _socket.socket.__init__(self, family, type, proto, fileno)
-        self.rq = b""
+        self.rbuf = bytearray() # receive buffer, valid data is rbuf[rpos:rend]
+        self.rpos = 0           # offset of the first unconsumed byte
+        self.rend = 0           # offset just past the last received byte
 
     """Accept a new connection on the underlying socket."""
     def accept(self):
@@ -56,7 +66,7 @@ class socket(_socket.socket):
     less than the full length of the data."""
     def send(self, data):
         if isinstance(data, str):
-            data = str.encode()
+            data = data.encode()
         return _socket.socket.send(self, data)
 
     """Send to the underlying socket, but accepts strings or bytes."""
@@ -65,48 +75,120 @@ class socket(_socket.socket):
             data = data.encode()
         return _socket.socket.sendall(self, data)
 
+    """Send a list of buffers (strings or bytes) to the underlying socket with
+    as few sendmsg() calls as possible, usually just one, without first
+    joining them together."""
+    def sendmsg_all(self, buffers):
+        views = [memoryview(b.encode() if isinstance(b, str) else b) for b in buffers]
+        views = [v for v in views if len(v) > 0]
+        while views:
+            n = _socket.socket.sendmsg(self, views)
+            while n > 0:
+                if n >= len(views[0]):
+                    n -= len(views[0])
+                    views.pop(0)
+                else:
+                    views[0] = views[0][n:]
+                    n = 0
+
+    """Return the number of bytes received but not yet consumed."""
+    def buffered(self):
+        return self.rend - self.rpos
+
+    """Make sure there is room for at least n more bytes at the end of the
+    receive buffer, first by moving unconsumed data to the front, then by
+    growing the buffer (at least doubling it, so growth is amortized)."""
+    def _reserve(self, n):
+        if len(self.rbuf) - self.rend >= n:
+            return
+        if self.rpos > 0:
+            del self.rbuf[:self.rpos] # cheap for bytearrays
+            self.rend -= self.rpos
+            self.rpos = 0
+        short = n - (len(self.rbuf) - self.rend)
+        if short > 0:
+            self.rbuf.extend(bytes(max(short, len(self.rbuf))))
+
+    """Receive more data from the underlying socket into the end of the receive
+    buffer. Returns the number of bytes received, 0 if the connection closed."""
+    def _fill(self, n=RECV_CHUNK):
+        self._reserve(n)
+        with memoryview(self.rbuf) as view:
+            got = _socket.socket.recv_into(self, view[self.rend:self.rend+n])
+        self.rend += got
+        return got
+
+    """Remove n bytes from the front of the receive buffer and return them as
+    a bytes object."""
+    def _take(self, n):
+        with memoryview(self.rbuf) as view:
+            data = view[self.rpos:self.rpos+n].tobytes()
+        self._skip(n)
+        return data
+
+    """Copy up to n buffered bytes into buffer, returning the number copied."""
+    def _take_into(self, buffer, n):
+        n = min(n, self.rend - self.rpos)
+        with memoryview(buffer) as dst, memoryview(self.rbuf) as src:
+            dst[0:n] = src[self.rpos:self.rpos+n]
+        self._skip(n)
+        return n
+
+    """Discard n bytes from the front of the receive buffer. Once everything
+    has been consumed, the buffer is reused from the start."""
+    def _skip(self, n):
+        self.rpos += n
+        if self.rpos == self.rend:
+            self.rpos = self.rend = 0
+            if len(self.rbuf) > MAX_IDLE_BUFFER:
+                self.rbuf = bytearray()
+
     """Receive up to n bytes from the underlying socket."""
     def recv(self, n):
-        if len(self.rq) == 0:
+        if self.rend == self.rpos:
             return _socket.socket.recv(self, n)
         else:
-            data = self.rq
-            self.rq = b""
-            return data
+            return self._take(min(n, self.rend - self.rpos))
 
     """Receive up to buffersize bytes (or len(buffer) if buffersize is
     unspecified or zero) and store into an existing buffer."""
     def recv_into(self, buffer, buffersize=0):
-        if len(self.rq) == 0:
+        if self.rend == self.rpos:
             return _socket.socket.recv_into(self, buffer, buffersize)
         else:
             if not buffersize:
                 buffersize = len(buffer)
-            n = min(buffersize, len(self.rq))
-            buffer[0:n] = self.rq[0:n]
-            self.rq = self.rq[n:]
-            return n
+            return self._take_into(buffer, buffersize)
 
     """Like recv(), but also returns the sender's address info."""
     def recvfrom(self, n):
-        if len(self.rq) == 0:
+        if self.rend == self.rpos:
             return _socket.socket.recvfrom(self, n)
         else:
-            data = self.rq
-            self.rq = b""
-            return data
+            return self._take(min(n, self.rend - self.rpos)), self.getpeername()
 
     """Like recv_into(), but also returns the sender's address info."""
     def recvfrom_into(self, buffer, buffersize=0):
-        if len(self.rq) == 0:
+        if self.rend == self.rpos:
             return _socket.socket.recvfrom_into(self, buffer, buffersize)
         else:
             if not buffersize:
                 buffersize = len(buffer)
-            n = min(buffersize, len(self.rq))
-            buffer[0:n] = self.rq[0:n]
-            self.rq = self.rq[n:]
-            return n, self.getpeername()
+            return self._take_into(buffer, buffersize), self.getpeername()
+
+    """Push data back onto the front of the receive queue, so that the next
+    receive returns it first. This is handy when some other code has already
+    read past the point where this socket's new owner should start reading."""
+    def unrecv(self, data):
+        n = len(data)
+        if n == 0:
+            return
+        if n <= self.rpos:
+            self.rbuf[self.rpos-n:self.rpos] = data
+            self.rpos -= n
+        else:
+            self.rbuf[self.rpos:self.rpos] = data
+            self.rend += n
 
     """Recieve up to n bytes from the underlying socket, decoded as an ASCII string."""
     def recv_str(self, n):
@@ -116,13 +198,10 @@ class socket(_socket.socket):
     This returns a bytes object of length n, or None if there was an error
     before n bytes could be received from the socket."""
     def recv_exactly(self, n):
-        while len(self.rq) < n:
-            more = _socket.socket.recv(self, max(4096, n - len(self.rq)))
-            if not more:
+        while self.rend - self.rpos < n:
+            if not self._fill(max(RECV_CHUNK, n - (self.rend - self.rpos))):
                 return None
-            self.rq += more
-        data, self.rq = self.rq[0:n], self.rq[n:]
-        return data
+        return self._take(n)
     
     """Receive exactly n bytes from the underlying socket, no more, no less,
     and decode and return the result as an ASCII string.
@@ -146,14 +225,30 @@ class socket(_socket.socket):
     def recv_until(self, delim):
         if isinstance(delim, str):
             delim = delim.encode()
-        while delim not in self.rq:
-            more = _socket.socket.recv(self, 4096)
-            if not more:
-                return None
-            self.rq += more
-        data, self.rq = self.rq.split(delim, 1)
+        i = self._find(delim)
+        if i < 0:
+            return None
+        data = self._take(i - self.rpos)
+        self._skip(len(delim))
         return data
 
+    """Return the offset in the receive buffer of the first occurrence of delim
+    in the unconsumed data, receiving more data as needed, or -1 if the
+    connection closed first. Each search resumes where the previous one
+    stopped, so the buffered data is only scanned once."""
+    def _find(self, delim):
+        start = self.rpos
+        while True:
+            i = self.rbuf.find(delim, start, self.rend)
+            if i >= 0:
+                return i
+            # Next time, only look at the last few old bytes plus the new ones.
+            start = max(self.rpos, self.rend - len(delim) + 1)
+            offset = self.rpos
+            if not self._fill():
+                return -1
+            start -= offset - self.rpos # _fill() may have moved the data
+
     """Receive all bytes up to a delimiter of your choice, discarding the
     delimiter, then decode and return the result as an ASCII string.
     For example, recv_until("\n") will read and return all bytes up
@@ -175,12 +270,9 @@ class socket(_socket.socket):
     newlines and http-style "\r\n" newlines. It returns a string, or None if
     there was an error before a newline was seen."""
     def recv_line(self):
-        while b"\n" not in self.rq:
-            more = _socket.socket.recv(self, 4096)
-            if not more:
-                return None
-            self.rq += more
-        data, self.rq = self.rq.split(b"\n", 1)
+        data = self.recv_until(b"\n")
+        if data is None:
+            return None
         if data.endswith(b"\r"):
             data = data[:-1]
         return data.decode()
@@ -0,0 +1,222 @@
+# staticcache.py module
+
+"""
+This module contains an in-memory cache for the static files central serves
+from its web_files directory. The landing page assets are small and requested
+over and over, so instead of finding, opening, and reading the file for every
+request, each file is read once and kept in memory along with its mime type,
+ETag, and Last-Modified date, plus gzip (and, if the brotli package is
+installed, brotli) compressed copies for clients that accept them.
+
+Entries are kept in a least-recently-used list bounded by the total number of
+bytes stored. Every entry remembers the modification time and size of its
+file, and at most once every check_interval seconds a request for it checks
+(with a single stat) whether the file has changed, in which case it is read
+again. Files bigger than max_file_size are not kept in memory at all, only
+their metadata is, and central streams them straight from disk.
+
+Example usage:
+
+    import staticcache
+
+    files = staticcache.StaticCache("./web_files", max_bytes=16 << 20)
+    entry = files.get("/index.html")    # None if there is no such file
+    encoding, etag, body = entry.select("gzip, deflate")
+"""
+
+import collections
+import email.utils
+import gzip
+import mimetypes
+import os
+import threading
+import time
+
+try:
+    import brotli # if available, brotli compresses text a bit better than gzip
+except ImportError:
+    brotli = None
+
+check_interval = 1.0    # seconds between checks whether a cached file changed
+min_compress_size = 256 # don't bother compressing files smaller than this
+
+# Mime types for the kinds of files we expect to serve, anything else is looked
+# up with the mimetypes module.
+MIME_TYPES = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "application/javascript",
+    "json": "application/json",
+    "txt": "text/plain",
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "gif": "image/gif",
+    "svg": "image/svg+xml",
+    "ico": "image/x-icon",
+}
+
+# Only these kinds of files are worth compressing, images and the like are
+# already compressed.
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+"""Return the mime type for a file, based on its name."""
+def mime_type_for(path):
+    ext = path.rsplit(".", 1)[-1].lower() if "." in path else ""
+    mime_type = MIME_TYPES.get(ext)
+    if mime_type is None:
+        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    return mime_type
+
+"""Return the set of content codings a client accepts, given the value of its
+Accept-Encoding header (or None if it didn't send one)."""
+def accepted_encodings(accept_encoding):
+    accepted = set()
+    if not accept_encoding:
+        return accepted
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            accepted.add(parts[0].strip().lower())
+    return accepted
+
+"""Entry holds everything needed to answer a request for one static file. data
+is the contents of the file, or None if it is too big to keep in memory, and
+variants maps a content coding ("gzip" or "br") to a pair (etag, data) with a
+compressed copy of the contents."""
+class Entry:
+
+    def __init__(self, path, st, mime_type, data):
+        self.path = path
+        self.mime_type = mime_type
+        self.mtime = st.st_mtime
+        self.mtime_ns = st.st_mtime_ns
+        self.size = st.st_size
+        self.etag = '"%x-%x"' % (st.st_mtime_ns, st.st_size)
+        self.last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        self.data = data
+        self.variants = {}
+        self.checked = time.monotonic() # last time we checked the file is unchanged
+        if data is not None and len(data) >= min_compress_size and mime_type.startswith(COMPRESSIBLE):
+            self.add_variant("gzip", gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                self.add_variant("br", brotli.compress(data))
+
+    """Keep a compressed copy of the contents, if it is actually smaller."""
+    def add_variant(self, encoding, data):
+        if len(data) < len(self.data):
+            self.variants[encoding] = ('%s-%s"' % (self.etag[:-1], encoding), data)
+
+    """Number of bytes of memory this entry uses, roughly."""
+    def cost(self):
+        return len(self.data or b"") + sum(len(d) for (e, d) in self.variants.values())
+
+    """Pick the best representation for a client, given the value of its
+    Accept-Encoding header. Returns a tuple (encoding, etag, data), where
+    encoding is None for the uncompressed contents, and data is None if the
+    file has to be read from disk."""
+    def select(self, accept_encoding):
+        if self.variants:
+            accepted = accepted_encodings(accept_encoding)
+            for encoding in ("br", "gzip"):
+                if encoding in accepted and encoding in self.variants:
+                    etag, data = self.variants[encoding]
+                    return encoding, etag, data
+        return None, self.etag, self.data
+
+"""StaticCache maps url paths to Entry objects for the files under root,
+keeping at most max_bytes of file contents in memory."""
+class StaticCache:
+
+    def __init__(self, root, max_bytes=16 << 20, max_file_size=1 << 20):
+        self.root = os.path.normpath(root)
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.entries = collections.OrderedDict() # url path -> Entry
+        self.total = 0 # sum of cost() over all entries
+        self.lock = threading.Lock()
+
+    """Return the file system path for a url path, or None if the url path
+    doesn't correspond to a file under root."""
+    def resolve(self, url_path):
+        # There is a very real security risk that the requested path could
+        # include things like "..", allowing a malicious or curious client to
+        # access files outside of the root directory. First, "normalize" to
+        # eliminate ".." elements, then make sure the result is still under
+        # root, and finally check that it is actually a file.
+        path = os.path.normpath(self.root + "/" + url_path)
+        if not path.startswith(self.root + os.sep):
+            return None
+        if not os.path.isfile(path):
+            return None
+        return path
+
+    """Read a file and build its entry. Raises OSError if it can't be read."""
+    def load(self, path):
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            data = f.read() if st.st_size <= self.max_file_size else None
+        return Entry(path, st, mime_type_for(path), data)
+
+    """Return the Entry for a url path, or None if there is no such file.
+    Raises OSError if the file exists but can't be read."""
+    def get(self, url_path):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(url_path)
+            if entry is not None:
+                self.entries.move_to_end(url_path)
+                if now - entry.checked < check_interval:
+                    return entry
+                entry.checked = now # other threads can keep using it meanwhile
+
+        if entry is not None:
+            # Time to check whether the file changed since it was cached.
+            try:
+                st = os.stat(entry.path)
+                if st.st_mtime_ns == entry.mtime_ns and st.st_size == entry.size:
+                    return entry
+            except OSError:
+                pass
+            self.discard(url_path)
+
+        path = self.resolve(url_path)
+        if path is None:
+            return None
+        entry = self.load(path)
+        self.put(url_path, entry)
+        return entry
+
+    """Store an entry, evicting the least recently used ones as needed."""
+    def put(self, url_path, entry):
+        cost = entry.cost()
+        if cost > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(url_path, None)
+            if old is not None:
+                self.total -= old.cost()
+            self.entries[url_path] = entry
+            self.total += cost
+            while self.total > self.max_bytes:
+                (key, victim) = self.entries.popitem(last=False)
+                self.total -= victim.cost()
+
+    """Forget the entry for a url path, if there is one."""
+    def discard(self, url_path):
+        with self.lock:
+            old = self.entries.pop(url_path, None)
+            if old is not None:
+                self.total -= old.cost()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,55 @@
+# template.py module
+
+"""
+This module contains a tiny template engine for the HTML pages central serves.
+A template is compiled once, when central starts, into a list of pre-encoded
+bytes objects for the static parts of the page and the names of the slots in
+between them. Rendering a page then only has to encode and escape the values
+that change, and join everything together in one go, rather than building the
+whole page out of dozens of string concatenations on every request.
+
+Slots are written as {{name}} in the template text. Values are converted with
+str() and HTML-escaped when rendered, unless they are bytes, which are assumed
+to be already-rendered HTML (e.g. the output of another template) and are
+inserted as is.
+
+Example usage:
+
+    import template
+
+    page = template.Template("<h1>Hello {{name}}</h1>")
+    body = page.render(name="<world>")     # b"<h1>Hello &lt;world&gt;</h1>"
+"""
+
+import html
+import re
+
+SLOT = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+"""Template is a compiled template. parts holds the static parts of the text
+as bytes, and slots holds the slot names, with slot i falling between parts i
+and i+1."""
+class Template:
+
+    def __init__(self, text):
+        pieces = SLOT.split(text)
+        self.parts = [p.encode() for p in pieces[0::2]]
+        self.slots = pieces[1::2]
+
+    """Render the template with the given values for its slots, returning
+    bytes. Raises KeyError if a slot has no value."""
+    def render(self, **values):
+        if not self.slots:
+            return self.parts[0]
+        out = [self.parts[0]]
+        for (name, part) in zip(self.slots, self.parts[1:]):
+            out.append(encode(values[name]))
+            out.append(part)
+        return b"".join(out)
+
+"""Encode a value for insertion into a page: bytes are inserted as is, and
+anything else is converted to a string and HTML-escaped."""
+def encode(value):
+    if isinstance(value, bytes):
+        return value
+    return html.escape(str(value)).encode()
@@ -0,0 +1,54 @@
+# urlutil.py module
+
+"""
+This module contains helpers for picking apart the target urls that users ask
+us to analyze. Both central and the workers use these, so that they agree on
+what host a url refers to.
+
+Example usage:
+
+    import urlutil
+
+    protocol, host, path = urlutil.split_url("http://www.Google.com/maps")
+    # protocol is "http", host is "www.Google.com", path is "/maps"
+    key = urlutil.normalize_host("http://www.Google.com:80/maps")
+    # key is "www.google.com"
+"""
+
+"""Split a url like "http://www.example.com/foo/bar" into a tuple (protocol,
+host, path). The protocol defaults to "http" and the path to "/" if they are
+missing. This raises ValueError if there is no host at all."""
+def split_url(url):
+    url = url.strip()
+    if "//" in url:
+        protocol, rest = url.split("//", 1)
+        protocol = protocol.rstrip(":").lower() or "http"
+    else:
+        protocol, rest = "http", url
+    host, slash, path = rest.partition("/")
+    if host == "":
+        raise ValueError("no host in url: %r" % (url))
+    return protocol, host, "/" + path
+
+"""Return the normalized host name for a url, suitable for use as a key when
+remembering things about that host. The host is lower-cased, and any trailing
+dot or default port number is removed."""
+def normalize_host(url):
+    protocol, host, path = split_url(url)
+    host = host.lower()
+    if protocol == "http" and host.endswith(":80"):
+        host = host[:-3]
+    elif protocol == "https" and host.endswith(":443"):
+        host = host[:-4]
+    return host.rstrip(".")
+
+"""Return just the host name (or IP address) in a url, without any port number,
+or the brackets around an IPv6 address, e.g. for looking it up in DNS. This
+raises ValueError if there is no host at all."""
+def host_name(url):
+    protocol, host, path = split_url(url)
+    if host.startswith("["):
+        return host[1:].split("]", 1)[0]
+    if host.count(":") == 1:
+        return host.split(":", 1)[0]
+    return host
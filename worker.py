@@ -1,11 +1,17 @@
 # Kevin E + Tim W + Liam D 
-# receives url from central, fetches/calculates 5 rtt estimates and sends to central
-# also print web fetched http response in console
+# receives url from central, measures rtt samples to it and sends them to central
 #!/usr/bin/env python3
 
 import os, sys, socket 
 import socketutil
+import channel
+import urlutil
+import dnscache
+import measure
+import threading
 import time  
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 import cloud   #include for deployment stuff
 
@@ -18,52 +24,85 @@ server_host = "54.235.59.70"
 #server_host = "localhost" 
 server_port = 8080
 server_addr = (server_host, server_port)
-rtt_times = []
+max_jobs = 32 # max number of targets probed at the same time
 
 worker_info = []
 worker_info.append(worker_city)
 worker_info.append(worker_coords)
 
-def url_fetch(host,path):
-    req = "GET " + path + " HTTP/1.1" + "\r\n"
-    req += "Host: " + host + "\r\n"
-    req += "Accept: text/html\r\nConnection: close\r\n\r\n"
-
-    return(req)
-
-def url_rtt(req, fetching_socket):         
-    for i in range(5):
-        #take rtt + append
-        start = time.time()
-        resp = fetching_socket.sendall(req.encode())
-        resp = fetching_socket.recv_line()
-        end = time.time()
-        rtt = end - start
-        rtt_times.append(rtt)
-    return(rtt_times)
-
 #splits the url from path
+#returns [host, path], using the same parsing as central
 def url_splitting(info):
+    url_protocol, url_host, url_path = urlutil.split_url(info)
+    return [url_host, url_path]
 
-    #splits out unnecessary chars, seps into protocol/host/path
-    info_split = info.split("\n")
-    url = info_split[0]
-    protocol = url.split(":")
-    url_protocol = protocol[0]
 
-    h = url.split("//")
-    g = h[1]
+# probe_url() measures the rtt to one url with the given measurement mode and
+# number of samples (see measure.py), returning the target's ip address and a
+# list of rtt samples in seconds. It raises an exception if the target can't be
+# reached.
+def probe_url(url, mode, samples):
+    host = url_splitting(url)
 
-    host = g.split("/")
-        
-    url_host = host[0] 
+    # dns query, answered from the cache when possible
+    ip_address = dnscache.resolve(host[0])
+    url_host = host[0]
     url_path = host[1]
-    #check if no path
-    if url_path == '':
-        url_path = '/' 
-       
-    return(host)
 
+    rtt_times = measure.measure(ip_address, url_host, url_path, mode, samples)
+    return str(ip_address), rtt_times
+
+
+# Jobs from central are run on a bounded pool of max_jobs threads, so we can probe
+# many targets at once while the main loop keeps reading new jobs. If central
+# sends a job for a url that is already being probed the same way, the new job
+# just waits for that probe to finish instead of starting another one. The
+# inflight dict maps each (url, mode, samples) being probed to the list of job
+# ids waiting for its result, and should only be touched with inflight_lock
+# held.
+job_pool = None
+inflight = {}
+inflight_lock = threading.Lock()
+
+# submit_job() queues one job from central on the job pool.
+def submit_job(ch, job_id, url, mode, samples):
+    key = (url, mode, samples)
+    with inflight_lock:
+        if key in inflight:
+            inflight[key].append(job_id)
+            return
+        inflight[key] = [job_id]
+    job_pool.submit(run_job, ch, url, mode, samples)
+
+# run_job() probes one url and sends the result (or an error) back on the
+# channel, once for every job id that was waiting on that probe.
+def run_job(ch, url, mode, samples):
+    try:
+        ip_address, rtt_times = probe_url(url, mode, samples)
+        error = None
+    except Exception as e:
+        print("probing %s failed: %s" % (url, e))
+        error = str(e)
+
+    with inflight_lock:
+        job_ids = inflight.pop((url, mode, samples))
+    for job_id in job_ids:
+        try:
+            if error is None:
+                ch.send_result(job_id, ip_address, rtt_times)
+            else:
+                ch.send_error(job_id, error)
+        except OSError as e:
+            print("could not send result for job %d: %s" % (job_id, e))
+
+
+# Command-line options can override the size of the job pool, e.g.
+#   python3 worker.py --jobs 64
+parser = argparse.ArgumentParser()
+parser.add_argument("--jobs", type=int, default=max_jobs)
+options, _ = parser.parse_known_args()
+max_jobs = options.jobs
+job_pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="job")
 
 print("Connecting to the central server at %s:%d" % (server_host, server_port))
 c = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -77,7 +116,8 @@ cont_len = len(msg.encode('utf-8'))
 
 req = "GET " + "/register_worker" + " HTTP/1.1" + "\r\n"
 req += "Host: " + "127.0.0.1" + "\r\n"
-req += "Accept: text/html\r\nConnection: keep-alive\r\n"
+req += "Accept: text/html\r\nConnection: Upgrade\r\n"
+req += "Upgrade: " + channel.PROTOCOL + "\r\n"
 req += "Content-Type: text/html\r\n"
 req += "Content-Length: " + str(cont_len) + "\r\n\r\n"
 req += msg
@@ -85,50 +125,34 @@ req += msg
 
 c.sendall(req)
 
+# Wait for central to agree to switch protocols, after that the connection is a
+# channel carrying frames in both directions.
+resp = c.recv_str_until("\r\n\r\n")
+if resp is None or not resp.startswith("HTTP/1.1 101"):
+    print("central refused to register us: %s" % (resp))
+    c.close()
+    sys.exit(1)
+ch = channel.Channel(c)
+
 try: 
     while True:
-        info = c.recv_line()
-        print("server says: %s" % (info))
-
-        # take info and do get request using url
-        
-        if "www" in info:
-            host = url_splitting(info)
-
-            # dns query
-            ip_address = socket.gethostbyname(host[0])
-            #url_host = ip_address
-            url_host = host[0]
-            url_path = host[1]
-            
-
-            fetching_socket = socketutil.socket(socket.AF_INET, socket.SOCK_STREAM)
-            fetching_socket.connect((url_host,80)) #web listens at port 80
-
-            #create get method to fetch url, record rtt times
-            req = url_fetch(url_host,url_path)
-            rtt_times = url_rtt(req, fetching_socket)
-
-            
-            #prepare get method to send rtts to central
-            msg = "worker_info: " + str(worker_info)  + "\r\n"
-            msg += "rtt_times: " + str(rtt_times) + "\r\n"
-            msg += "ip: " + str(ip_address)  + "\r\n"
-
-            
-            cont_len = len(msg.encode('utf-8'))
-            
-            req = "GET " + "/rtt-time" + " HTTP/1.1" + "\r\n"
-            req += "Host: " + "127.0.0.1" + "\r\n"
-            req += "Accept: text/html\r\nConnection: keep-alive\r\n"
-            req += "Upgrade-Insecure-Requests: 1\r\n"
-            req += "Content-Type: text/html\r\n"
-            req += "Content-Length: " + str(cont_len) + "\r\n\r\n"
-            req += msg     #change w rtt_times 
-            c.sendall(req)
-            rtt_times = []
+        frame = ch.recv_frame()
+        if frame is None:
+            break
+        kind, job_id, payload = frame
+        if kind == channel.JOB:
+            jobs, mode, samples = channel.unpack_job(payload)
+            for (job_id, url) in jobs:
+                print("server says: job %d %s (%s x%d)" % (job_id, url, mode, samples))
+                submit_job(ch, job_id, url, mode, samples)
+        elif kind == channel.PING:
+            ch.send_pong(job_id) # heartbeat from central, answer right away
+        else:
+            print("ignoring unknown frame kind %d from server" % (kind))
 
             
 finally:
     print("worker shutting down")
+    job_pool.shutdown(wait=False, cancel_futures=True)
+    measure.pool.close() # idle keep-alive connections to probed servers
     c.close()
\ No newline at end of file
@@ -0,0 +1,151 @@
+# workerhealth.py module
+
+"""
+This module keeps track of whether each worker connected to central is
+healthy enough to be sent jobs. Central sends every worker a PING frame every
+heartbeat_interval seconds, and the worker answers with a PONG. From those, and
+from how the worker handles its jobs, a Health object decides if the worker is:
+
+  * healthy: it is sent jobs like normal,
+  * unhealthy (evicted): it is still connected, but left out of the fan-out,
+    because it hasn't been heard from in liveness_timeout seconds, its
+    heartbeats are too slow (the moving average is above max_latency), it
+    never answered max_misses jobs in a row (not even late, job_timeout
+    seconds after they were sent), or a job couldn't even be sent to it,
+  * dead: it hasn't been heard from in dead_timeout seconds, and central should
+    close its connection and forget about it.
+
+An evicted worker is re-admitted once it has answered readmit_pongs heartbeats
+in a row, quickly enough, after it was evicted.
+
+The heartbeat latency is tracked as an exponentially weighted moving average
+(EWMA), so a single slow heartbeat doesn't evict a worker, but a worker that
+stays slow is evicted within a few heartbeats.
+
+Example usage:
+
+    import workerhealth
+
+    h = workerhealth.Health("Chicago")
+    h.sent_ping(seq)         # when sending a PING
+    h.got_pong(seq)          # when the PONG comes back
+    if h.is_healthy():
+        ...                  # send it jobs
+"""
+
+import threading
+import time
+
+heartbeat_interval = 5.0 # seconds between heartbeats to each worker
+liveness_timeout = 15.0  # seconds of silence before a worker is evicted
+dead_timeout = 60.0      # seconds of silence before a worker is disconnected
+max_latency = 1.0        # evict workers whose average heartbeat rtt is above this
+ewma_alpha = 0.3         # weight of the newest sample in the moving average
+job_timeout = 60.0       # seconds without any answer before a job counts as missed
+max_misses = 3           # evict workers that miss this many jobs in a row
+readmit_pongs = 2        # good heartbeats in a row needed to re-admit a worker
+
+"""Health tracks the liveness and latency of one worker. All methods are
+thread-safe."""
+class Health:
+
+    def __init__(self, name):
+        now = time.monotonic()
+        self.name = name        # the worker's name, for log messages
+        self.last_seen = now    # when we last got any frame from the worker
+        self.latency = None     # EWMA of heartbeat rtts, in seconds
+        self.ping_seq = None    # sequence number of the outstanding ping
+        self.ping_sent = None   # when the outstanding ping was sent
+        self.jobs = {}          # job ID -> when it was sent, for unanswered jobs
+        self.misses = 0         # jobs missed in a row
+        self.evicted = False    # True while left out of the fan-out
+        self.reason = None      # why the worker was evicted
+        self.good_pongs = 0     # good heartbeats in a row since being evicted
+        self.lock = threading.Lock()
+
+    """Record that some frame arrived from the worker."""
+    def got_frame(self):
+        with self.lock:
+            self.last_seen = time.monotonic()
+
+    """Record that a PING with the given sequence number was just sent."""
+    def sent_ping(self, seq):
+        with self.lock:
+            self.ping_seq = seq
+            self.ping_sent = time.monotonic()
+
+    """Record a PONG from the worker, updating the latency average and
+    possibly re-admitting the worker."""
+    def got_pong(self, seq):
+        with self.lock:
+            now = time.monotonic()
+            self.last_seen = now
+            if seq != self.ping_seq or self.ping_sent is None:
+                return # an old ping, or one we didn't send
+            rtt = now - self.ping_sent
+            self.ping_seq = None
+            if self.latency is None:
+                self.latency = rtt
+            else:
+                self.latency = ewma_alpha * rtt + (1 - ewma_alpha) * self.latency
+            if self.latency > max_latency:
+                self.evict("heartbeats too slow (%.0f ms)" % (1000 * self.latency))
+            elif self.evicted:
+                self.good_pongs += 1
+                if self.good_pongs >= readmit_pongs:
+                    self.evicted = False
+                    self.reason = None
+                    self.misses = 0
+
+    """Record that the job with the given ID is about to be sent."""
+    def job_sent(self, job_id):
+        with self.lock:
+            self.jobs[job_id] = time.monotonic()
+
+    """Record that the worker answered the job with the given ID, with a
+    result or an error, however late. A slow target is not the worker's
+    fault, so any answer at all counts."""
+    def job_answered(self, job_id):
+        with self.lock:
+            self.last_seen = time.monotonic()
+            self.jobs.pop(job_id, None)
+            self.misses = 0
+
+    """Count the jobs that haven't been answered within job_timeout seconds as
+    missed, evicting the worker if it missed max_misses in a row."""
+    def check_jobs(self):
+        with self.lock:
+            oldest = time.monotonic() - job_timeout
+            for (job_id, sent) in list(self.jobs.items()):
+                if sent < oldest:
+                    del self.jobs[job_id]
+                    self.misses += 1
+            if self.misses >= max_misses:
+                self.evict("never answered %d jobs in a row" % (self.misses))
+
+    """Record that a frame (the job with the given ID, if any) couldn't be
+    sent to the worker."""
+    def send_failed(self, job_id=None):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.evict("could not send to it")
+
+    """Leave the worker out of the fan-out, for the given reason. Must be
+    called with lock held."""
+    def evict(self, reason):
+        self.evicted = True
+        self.reason = reason
+        self.good_pongs = 0
+
+    """Return True if the worker should be sent jobs."""
+    def is_healthy(self):
+        with self.lock:
+            if time.monotonic() - self.last_seen > liveness_timeout:
+                self.evict("silent for over %d seconds" % (liveness_timeout))
+            return not self.evicted
+
+    """Return True if the worker has been silent for so long that it should be
+    disconnected."""
+    def is_dead(self):
+        with self.lock:
+            return time.monotonic() - self.last_seen > dead_timeout
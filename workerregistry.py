@@ -0,0 +1,77 @@
+# workerregistry.py module
+
+"""
+This module contains the registry of workers connected to central. Each worker
+gets a Worker record, keyed by a worker ID that central assigns when the worker
+registers, holding everything central knows about it: its channel, location,
+coordinates, nearest cloud region, and health.
+
+Readers (every /analyze request, the heartbeat thread, /metrics) never take a
+lock. Registering or removing a worker takes the registry's lock, builds a new
+tuple of all the records, and swaps it in, so a reader that grabbed the old
+tuple keeps a consistent view of the workers while the registry changes.
+The fields of a record are never changed after it is added (its health keeps
+track of itself, under its own lock).
+
+Example usage:
+
+    import workerregistry
+
+    registry = workerregistry.WorkerRegistry()
+    w = registry.add(ch, "Chicago", "(41.88, -87.63)", (41.88, -87.63), "us-east-2", health)
+    for w in registry.snapshot():       # a tuple, safe to use without locking
+        ch = w.channel
+    registry.remove(w.id)
+"""
+
+import itertools
+import threading
+
+"""Worker holds everything central knows about one registered worker."""
+class Worker:
+    __slots__ = ("id", "channel", "location", "coords", "latlon", "region", "health")
+
+    def __init__(self, worker_id, channel, location, coords, latlon, region, health):
+        self.id = worker_id
+        self.channel = channel
+        self.location = location
+        self.coords = coords   # as sent by the worker, like "(-33.93, 18.42)"
+        self.latlon = latlon   # the same, as a (lat, lon) pair of floats
+        self.region = region   # name of the known cloud region nearest to it
+        self.health = health   # workerhealth.Health
+
+"""WorkerRegistry holds the Worker records for all registered workers."""
+class WorkerRegistry:
+
+    def __init__(self):
+        self.by_id = {}        # worker ID -> Worker, only changed with lock held
+        self.workers = ()      # all records, replaced (never changed) on updates
+        self.next_id = itertools.count(1)
+        self.lock = threading.Lock()
+
+    """Register a new worker, returning its record."""
+    def add(self, channel, location, coords, latlon, region, health):
+        with self.lock:
+            w = Worker(next(self.next_id), channel, location, coords, latlon, region, health)
+            self.by_id[w.id] = w
+            self.workers = tuple(self.by_id.values())
+        return w
+
+    """Remove a worker, if it is still registered."""
+    def remove(self, worker_id):
+        with self.lock:
+            if self.by_id.pop(worker_id, None) is not None:
+                self.workers = tuple(self.by_id.values())
+
+    """Return a tuple of all registered workers, in the order they registered.
+    The tuple never changes, even if workers register or go away later."""
+    def snapshot(self):
+        return self.workers
+
+    """Return a list of the registered workers that are healthy enough to be
+    sent jobs."""
+    def healthy(self):
+        return [w for w in self.workers if w.health.is_healthy()]
+
+    def __len__(self):
+        return len(self.workers)